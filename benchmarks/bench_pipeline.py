@@ -0,0 +1,286 @@
+"""End-to-end throughput benchmark of drive_backup_fixer.py against a local fake Drive.
+
+Generates a synthetic backup tree (placeholders for binary files, Google shortcut JSON
+files and genuinely small real files), starts benchmarks/fake_drive_server.py with the
+matching Drive contents, runs the fixer's main() against it in non-demo mode and reports
+per-phase throughput as JSON:
+
+* scan:     candidates/sec of the local scan on its own, peak RSS afterwards
+* resolve:  metadata lookups (files.get, files.list, batches) and their active window
+* download: files and bytes/sec of get_media and export calls
+* total:    wall time, placeholders/sec, API calls and HTTP requests per placeholder, peak RSS
+* fixer:    the fixer's own run summary (counters and lookup/download latency histograms)
+
+Since the fixer runs its stages concurrently, resolve and download times are the windows
+between the first and last request of each kind as seen by the server.
+
+Usage:
+    python benchmarks/bench_pipeline.py --placeholders 2000 --shortcuts 2000 --real-small 500 \\
+        --latency 0.03 --error-rate 0.01 --output results.json
+    python benchmarks/bench_pipeline.py --set DOWNLOAD_WORKERS=16 --set USE_DRIVE_INDEX=true --compare results.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+import drive_backup_fixer as fixer
+from fake_drive_server import file_content
+
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build_from_document
+
+RESOLVE_KINDS = ('files.get', 'files.list', 'batch')
+DOWNLOAD_KINDS = ('files.get_media', 'files.export')
+SHORTCUT_TYPES = [
+    ('.gdoc', 'application/vnd.google-apps.document'),
+    ('.gsheet', 'application/vnd.google-apps.spreadsheet'),
+    ('.gslides', 'application/vnd.google-apps.presentation'),
+]
+
+
+def generate_backup(root, args):
+    """Writes the local tree and returns the Drive file model that matches it."""
+    rng = random.Random(args.seed)
+    files = []
+    folder_ids = []
+    for d in range(args.dirs):
+        folder_id = f"folder{d}"
+        folder_ids.append(folder_id)
+        files.append({'id': folder_id, 'name': f"dir{d:04d}", 'mimeType': fixer.FOLDER_MIMETYPE})
+        os.makedirs(os.path.join(root, f"dir{d:04d}"), exist_ok=True)
+
+    def place(i):
+        d = i % args.dirs
+        return os.path.join(root, f"dir{d:04d}"), folder_ids[d]
+
+    for i in range(args.placeholders):
+        local_dir, parent = place(i)
+        name = f"file{i}.bin"
+        open(os.path.join(local_dir, name), 'wb').close() # Zero-byte placeholder
+        if rng.random() >= args.missing_ratio:
+            size = max(0, int(rng.gauss(args.file_size, args.file_size / 4)))
+            files.append({'id': f"bin{i}", 'name': name, 'mimeType': 'application/octet-stream', 'parents': [parent], 'size': size})
+
+    for i in range(args.shortcuts):
+        local_dir, parent = place(i)
+        extension, mime_type = SHORTCUT_TYPES[i % len(SHORTCUT_TYPES)]
+        with open(os.path.join(local_dir, f"doc{i}{extension}"), 'w', encoding='utf-8') as f:
+            json.dump({'doc_id': f"gdoc{i}"}, f)
+        if rng.random() >= args.missing_ratio:
+            files.append({'id': f"gdoc{i}", 'name': f"doc{i}", 'mimeType': mime_type, 'parents': [parent]})
+
+    for i in range(args.real_small):
+        # Genuine small files whose content matches Drive.
+        local_dir, parent = place(i)
+        file_id = f"small{i}"
+        size = rng.randint(1, fixer.SIZE_THRESHOLD_BYTES - 1)
+        with open(os.path.join(local_dir, f"note{i}.txt"), 'wb') as f:
+            f.write(file_content(file_id, 0, size))
+        files.append({'id': file_id, 'name': f"note{i}.txt", 'mimeType': 'text/plain', 'parents': [parent], 'size': size})
+    return files
+
+
+def start_server(model_path, args):
+    command = [sys.executable, os.path.join(HERE, 'fake_drive_server.py'), '--model', model_path,
+               '--latency', str(args.latency), '--latency-jitter', str(args.latency_jitter),
+               '--error-rate', str(args.error_rate), '--export-size', str(args.export_size)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip()
+    if not url.startswith('http'):
+        process.kill()
+        raise RuntimeError("Fake Drive server did not start.")
+    return process, url
+
+
+def point_fixer_at(url):
+    """Makes the fixer build its Drive clients against the fake server, without OAuth."""
+    discovery_path = os.path.join(os.path.dirname(sys.modules['googleapiclient'].__file__),
+                                  'discovery_cache', 'documents', 'drive.v3.json')
+    with open(discovery_path, 'r', encoding='utf-8') as f:
+        document = json.load(f)
+    document['rootUrl'] = url + '/'
+    document['baseUrl'] = url + '/drive/v3/'
+    fixer.get_credentials = AnonymousCredentials
+    fixer.build_drive_client = lambda creds: build_from_document(document, credentials=creds)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1) # bytes on macOS, KB elsewhere
+
+
+def window(endpoints, kinds):
+    """(requests, seconds between first and last request) over the given endpoint kinds."""
+    entries = [v for k, v in endpoints.items() if k.split('[')[0] in kinds]
+    if not entries:
+        return 0, 0.0
+    return sum(e['requests'] for e in entries), max(e['last'] for e in entries) - min(e['first'] for e in entries)
+
+
+def rate(count, seconds):
+    return round(count / seconds, 2) if seconds > 0 else None
+
+
+def parse_setting(text):
+    name, _, value = text.partition('=')
+    if not hasattr(fixer, name):
+        raise argparse.ArgumentTypeError(f"drive_backup_fixer has no setting named {name}")
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    backup = os.path.join(work_dir, 'backup')
+    os.makedirs(backup)
+    process = None
+    try:
+        files = generate_backup(backup, args)
+        model_path = os.path.join(work_dir, 'model.json')
+        with open(model_path, 'w', encoding='utf-8') as f:
+            json.dump({'files': files}, f)
+        process, url = start_server(model_path, args)
+
+        fixer.LOCAL_BACKUP_PATH = backup
+        fixer.DEMO_MODE = False
+        fixer.STATE_DB_FILE = os.path.join(work_dir, 'state.sqlite3')
+        fixer.LOST_FILES_LOG = os.path.join(work_dir, 'lost_or_failed_files.txt')
+        fixer.DRIVE_INDEX_FILE = os.path.join(work_dir, 'drive_index.json')
+        fixer.EVENT_LOG_FILE = os.path.join(work_dir, 'events.jsonl')
+        fixer.RUN_SUMMARY_FILE = os.path.join(work_dir, 'summary.json')
+        fixer.EXPORT_CACHE_DIR = os.path.join(work_dir, 'export_cache') # Starts empty, like a first run
+        for name, value in args.set:
+            setattr(fixer, name, value)
+        point_fixer_at(url)
+
+        start = time.perf_counter()
+        candidates = sum(1 for _ in fixer.scan_small_files(backup, fixer.SIZE_THRESHOLD_BYTES, fixer.EXCLUDED_EXTENSIONS))
+        scan_seconds = time.perf_counter() - start
+        scan_rss = peak_rss_mb()
+
+        console_log = os.path.join(work_dir, 'console.log')
+        start = time.perf_counter()
+        with open(console_log, 'w', encoding='utf-8') as out, contextlib.redirect_stdout(out):
+            fixer.main()
+        total_seconds = time.perf_counter() - start
+
+        with urllib.request.urlopen(url + '/__stats') as response:
+            server = json.load(response)
+        with contextlib.closing(sqlite3.connect(fixer.STATE_DB_FILE)) as conn:
+            outcomes = dict(conn.execute("SELECT outcome, COUNT(*) FROM placeholders GROUP BY outcome").fetchall())
+        with open(fixer.RUN_SUMMARY_FILE, 'r', encoding='utf-8') as f:
+            fixer_summary = json.load(f)
+        if args.keep:
+            print(f"Work directory kept at {work_dir} (console output in {console_log}).", file=sys.stderr)
+    finally:
+        if process:
+            process.kill()
+            process.wait()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    endpoints = server['endpoints']
+    resolve_calls, resolve_seconds = window(endpoints, RESOLVE_KINDS)
+    download_calls, download_seconds = window(endpoints, DOWNLOAD_KINDS)
+    api_calls = sum(v['requests'] for k, v in endpoints.items() if k != 'batch')
+    http_requests = sum(v['requests'] for k, v in endpoints.items() if not k.endswith('[batch]'))
+    processed = sum(outcomes.values())
+    return {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'set', 'keep')},
+        'settings': {name: value for name, value in args.set},
+        'scan': {
+            'seconds': round(scan_seconds, 3),
+            'candidates': candidates,
+            'candidates_per_sec': rate(candidates, scan_seconds),
+            'peak_rss_mb': scan_rss,
+        },
+        'resolve': {
+            'seconds': round(resolve_seconds, 3),
+            'api_calls': resolve_calls,
+            'placeholders_per_sec': rate(processed, resolve_seconds),
+        },
+        'download': {
+            'seconds': round(download_seconds, 3),
+            'files': download_calls,
+            'files_per_sec': rate(download_calls, download_seconds),
+            'bytes': server['bytes_served'],
+            'bytes_per_sec': rate(server['bytes_served'], download_seconds),
+        },
+        'total': {
+            'seconds': round(total_seconds, 3),
+            'placeholders': processed,
+            'placeholders_per_sec': rate(processed, total_seconds),
+            'api_calls': api_calls,
+            'http_requests': http_requests,
+            'api_calls_per_placeholder': round(api_calls / processed, 3) if processed else None,
+            'http_requests_per_placeholder': round(http_requests / processed, 3) if processed else None,
+            'outcomes': outcomes,
+            'peak_rss_mb': peak_rss_mb(),
+        },
+        'server': server,
+        'fixer': fixer_summary,
+    }
+
+
+def compare(result, previous):
+    """Prints the relative change of the headline numbers against an earlier result file."""
+    headline = [('scan', 'candidates_per_sec'), ('resolve', 'placeholders_per_sec'), ('download', 'bytes_per_sec'),
+                ('total', 'placeholders_per_sec'), ('total', 'api_calls_per_placeholder'), ('total', 'peak_rss_mb')]
+    print("Change against previous run:", file=sys.stderr)
+    for phase, key in headline:
+        old, new = previous.get(phase, {}).get(key), result[phase][key]
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else "n/a"
+        print(f"  {phase}.{key}: {old} -> {new} ({change})", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--placeholders', type=int, default=500, help="Zero-byte placeholders of binary files.")
+    parser.add_argument('--shortcuts', type=int, default=500, help="Google Docs/Sheets/Slides shortcut files.")
+    parser.add_argument('--real-small', type=int, default=100, help="Genuine small files that match Drive.")
+    parser.add_argument('--missing-ratio', type=float, default=0.05, help="Fraction of placeholders/shortcuts missing on Drive.")
+    parser.add_argument('--dirs', type=int, default=50)
+    parser.add_argument('--file-size', type=int, default=256 * 1024, help="Mean size of binary files on Drive.")
+    parser.add_argument('--export-size', type=int, default=64 * 1024, help="Size of every Workspace export.")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds of server latency per request.")
+    parser.add_argument('--latency-jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of calls answered with 429.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--set', type=parse_setting, action='append', default=[], metavar='NAME=VALUE',
+                        help="Override a drive_backup_fixer setting, e.g. DOWNLOAD_WORKERS=8 (value parsed as JSON).")
+    parser.add_argument('--output', help="Write the JSON result here instead of stdout.")
+    parser.add_argument('--compare', help="Earlier JSON result to compare against.")
+    parser.add_argument('--keep', action='store_true', help="Keep the generated tree, state and console log.")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
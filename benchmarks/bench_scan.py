@@ -0,0 +1,110 @@
+"""Benchmark of the local placeholder scan.
+
+Generates a synthetic backup tree and times the scandir-based scanner in
+drive_backup_fixer.py against the original os.walk implementation it replaced.
+
+Usage:
+    python benchmarks/bench_scan.py --dirs 200 --files-per-dir 500
+    python benchmarks/bench_scan.py --tree /mnt/nas/backup   # scan an existing tree instead
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import drive_backup_fixer as fixer
+
+
+def find_small_files_os_walk(backup_path, threshold, excluded_exts):
+    """The original implementation: os.walk plus isfile/islink/getsize per file."""
+    small_files = []
+    for root, _, files in os.walk(backup_path):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            try:
+                if os.path.isfile(filepath) and not os.path.islink(filepath):
+                    filesize = os.path.getsize(filepath)
+                    _, ext = os.path.splitext(filename)
+                    common_excluded = excluded_exts + [".ds_store"]
+                    if filesize < threshold and ext.lower() not in common_excluded:
+                        small_files.append(filepath)
+            except OSError as e:
+                print(f"Warning: Could not access or get size of {filepath}: {e}")
+    return small_files
+
+
+def generate_tree(root, top_dirs, dirs_per_top, files_per_dir, small_ratio):
+    """Creates top_dirs * dirs_per_top folders with files_per_dir files each; small_ratio of them are placeholders."""
+    small_every = max(1, int(round(1 / small_ratio))) if small_ratio > 0 else 0
+    big_content = b"x" * 1024
+    count = 0
+    for t in range(top_dirs):
+        for d in range(dirs_per_top):
+            folder = os.path.join(root, f"top{t:03d}", f"sub{d:03d}")
+            os.makedirs(folder, exist_ok=True)
+            for i in range(files_per_dir):
+                count += 1
+                if small_every and count % small_every == 0:
+                    with open(os.path.join(folder, f"doc{i}.gdoc"), 'w') as f:
+                        f.write('{"doc_id": "id%d"}' % count)
+                else:
+                    with open(os.path.join(folder, f"file{i}.bin"), 'wb') as f:
+                        f.write(big_content)
+    return count
+
+
+def best_of(repeat, func):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tree', help="Scan this existing directory instead of generating one.")
+    parser.add_argument('--top-dirs', type=int, default=16)
+    parser.add_argument('--dirs', type=int, default=50, help="Sub-folders per top-level folder.")
+    parser.add_argument('--files-per-dir', type=int, default=200)
+    parser.add_argument('--small-ratio', type=float, default=0.1, help="Fraction of generated files that are placeholders.")
+    parser.add_argument('--workers', type=int, default=fixer.SCAN_WORKERS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tree = args.tree
+    temp_root = None
+    if not tree:
+        temp_root = tempfile.mkdtemp(prefix="bench_scan_")
+        tree = temp_root
+        print(f"Generating tree in {tree}...")
+        total = generate_tree(tree, args.top_dirs, args.dirs, args.files_per_dir, args.small_ratio)
+        print(f"Generated {total} files in {args.top_dirs * args.dirs} folders.")
+
+    try:
+        threshold, excluded = fixer.SIZE_THRESHOLD_BYTES, fixer.EXCLUDED_EXTENSIONS
+        legacy_time, legacy = best_of(args.repeat, lambda: find_small_files_os_walk(tree, threshold, excluded))
+        serial_time, serial = best_of(args.repeat, lambda: list(fixer.scan_small_files(tree, threshold, excluded, workers=1)))
+        parallel_time, parallel = best_of(args.repeat, lambda: list(fixer.scan_small_files(tree, threshold, excluded, workers=args.workers)))
+
+        legacy_set = set(legacy)
+        for name, found in (("scandir", serial), (f"scandir x{args.workers}", parallel)):
+            if {path for path, _ in found} != legacy_set:
+                print(f"WARNING: {name} found {len(found)} candidates, os.walk found {len(legacy)}.")
+
+        print(f"\nCandidates found: {len(legacy)} (best of {args.repeat} runs)")
+        print(f"  os.walk (original)     : {legacy_time:8.3f} s")
+        print(f"  scandir, 1 thread      : {serial_time:8.3f} s  ({legacy_time / serial_time:.2f}x)")
+        print(f"  scandir, {args.workers:2d} threads    : {parallel_time:8.3f} s  ({legacy_time / parallel_time:.2f}x)")
+    finally:
+        if temp_root:
+            shutil.rmtree(temp_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""A local stand-in for the parts of the Google Drive v3 API that drive_backup_fixer.py uses.
+
+Serves files.get (metadata and alt=media, with Range support), files.export, files.list
+(name queries and full listings), changes.getStartPageToken, changes.list and batch
+requests, for a set of files described in a JSON model file. POST /__touch?id=<file id>
+makes a new version of a file and POST /__remove?id=<file id> deletes it, both showing up
+in the changes feed. Latency, error rate and file contents are synthetic and configurable, so
+the fixer can be benchmarked without touching a real Drive. Request counts and bytes
+served are available at GET /__stats; calls made inside a batch request are counted
+under their own "<endpoint>[batch]" key.
+
+Usage:
+    python benchmarks/fake_drive_server.py --model files.json --port 8765 --latency 0.02 --error-rate 0.01
+
+The model file holds {"files": [...]} with Drive-style metadata per file (id, name,
+mimeType, parents, size for binary files); see bench_pipeline.py for how it is generated.
+"""
+import argparse
+import email.parser
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICE_PATH = '/drive/v3/'
+BATCH_PATH = '/batch/drive/v3'
+GOOGLE_APPS_PREFIX = 'application/vnd.google-apps.'
+
+
+def file_content(file_id, start, end):
+    """Deterministic synthetic bytes [start, end) of a file."""
+    block = hashlib.sha256(file_id.encode('utf-8')).digest() * 128 # 4 KB pattern per file
+    first = start % len(block)
+    out = bytearray()
+    while len(out) < end - start:
+        out += block[first:]
+        first = 0
+    return bytes(out[:end - start])
+
+
+def content_key(f):
+    """What a file's content is generated from: its ID, plus its version once it has been modified."""
+    return f['id'] if f['version'] == '1' else f"{f['id']}@{f['version']}"
+
+
+def content_md5(file_id, size):
+    md5 = hashlib.md5()
+    for start in range(0, size, 1 << 20):
+        md5.update(file_content(file_id, start, min(size, start + (1 << 20))))
+    return md5.hexdigest()
+
+
+class FakeDrive:
+    """The file model plus counters, shared by all request handler threads."""
+
+    def __init__(self, files, latency=0.0, latency_jitter=0.0, error_rate=0.0, export_size=64 * 1024):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.export_size = export_size
+        self.files = {}
+        for f in files:
+            f = dict(f)
+            f.setdefault('capabilities', {'canDownload': True})
+            f.setdefault('modifiedTime', '2024-01-01T00:00:00.000Z')
+            f.setdefault('version', '1')
+            if not f['mimeType'].startswith(GOOGLE_APPS_PREFIX):
+                f['size'] = str(int(f.get('size', 0)))
+                f['md5Checksum'] = content_md5(content_key(f), int(f['size']))
+            self.files[f['id']] = f
+        self.ordered = sorted(self.files.values(), key=lambda f: f['id'])
+        self.changes = [] # File IDs in the order they changed; a page token is an index into this list
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.bytes_served = 0
+        self.started = time.time()
+
+    def count(self, kind, nbytes=0):
+        with self.lock:
+            entry = self.stats.setdefault(kind, {'requests': 0, 'first': None, 'last': None})
+            now = time.time() - self.started
+            entry['requests'] += 1
+            entry['first'] = now if entry['first'] is None else entry['first']
+            entry['last'] = now
+            self.bytes_served += nbytes
+
+    def snapshot(self):
+        with self.lock:
+            return {'endpoints': json.loads(json.dumps(self.stats)), 'bytes_served': self.bytes_served}
+
+    def should_fail(self):
+        """True if this call should be answered with a 429."""
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def delay_and_maybe_fail(self):
+        """Applies the configured latency; returns True if this request should fail with a 429."""
+        if self.latency or self.latency_jitter:
+            time.sleep(self.latency + random.uniform(0, self.latency_jitter))
+        return self.should_fail()
+
+    def touch(self, file_id):
+        """Makes a new version of a file (new content, checksum and modifiedTime). False if there is no such file."""
+        with self.lock:
+            f = self.files.get(file_id)
+            if f is None:
+                return False
+            f['version'] = str(int(f['version']) + 1)
+            f['modifiedTime'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+            if 'size' in f:
+                f['md5Checksum'] = content_md5(content_key(f), int(f['size']))
+            self.changes.append(file_id)
+            return True
+
+    def remove(self, file_id):
+        with self.lock:
+            if self.files.pop(file_id, None) is None:
+                return False
+            self.ordered = sorted(self.files.values(), key=lambda f: f['id'])
+            self.changes.append(file_id)
+            return True
+
+    def list_changes(self, page_size, page_token):
+        with self.lock:
+            start = int(page_token)
+            page = {'changes': []}
+            for file_id in self.changes[start:start + page_size]:
+                f = self.files.get(file_id)
+                page['changes'].append({'fileId': file_id, 'removed': f is None, **({'file': dict(f)} if f else {})})
+            if start + page_size < len(self.changes):
+                page['nextPageToken'] = str(start + page_size)
+            else:
+                page['newStartPageToken'] = str(len(self.changes))
+            return page
+
+    def list_files(self, q, page_size, page_token):
+        q = q or ''
+        match = re.search(r"name = '((?:[^'\\]|\\.)*)'", q)
+        if match:
+            name = match.group(1).replace("\\'", "'")
+            items = [f for f in self.ordered if f['name'] == name]
+        else:
+            items = self.ordered
+        start = int(page_token or 0)
+        page = {'files': items[start:start + page_size]}
+        if start + page_size < len(items):
+            page['nextPageToken'] = str(start + page_size)
+        return page
+
+
+def error_body(code, reason, message):
+    return json.dumps({'error': {'code': code, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}).encode('utf-8')
+
+
+class DriveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    drive = None # Set on the subclass by make_server()
+
+    def log_message(self, format, *args):
+        pass # Keep the benchmark output clean
+
+    def send(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path == '/__stats':
+            self.send(200, json.dumps(self.drive.snapshot()).encode('utf-8'))
+            return
+        status, body, content_type, headers = self.handle_api_get(parsed, self.headers.get('Range'))
+        self.send(status, body, content_type, headers)
+
+    def do_POST(self):
+        parsed = urllib.parse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if parsed.path in ('/__touch', '/__remove'):
+            file_id = dict(urllib.parse.parse_qsl(parsed.query)).get('id', '')
+            found = (self.drive.touch if parsed.path == '/__touch' else self.drive.remove)(file_id)
+            self.send(200 if found else 404, json.dumps({'id': file_id, 'found': found}).encode('utf-8'))
+            return
+        if parsed.path != BATCH_PATH:
+            self.send(404, error_body(404, 'notFound', 'Unknown endpoint'))
+            return
+        self.drive.count('batch')
+        if self.drive.delay_and_maybe_fail():
+            self.send(429, error_body(429, 'rateLimitExceeded', 'Rate Limit Exceeded'))
+            return
+        self.handle_batch(self.headers.get('Content-Type'), body)
+
+    def handle_api_get(self, parsed, range_header=None, in_batch=False):
+        """Returns (status, body, content_type, extra_headers) for one GET against the API."""
+        drive = self.drive
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        path = parsed.path[len(SERVICE_PATH):] if parsed.path.startswith(SERVICE_PATH) else None
+        parts = path.split('/') if path is not None else []
+        if parts[:1] == ['changes']:
+            return self.handle_changes(parts, params, in_batch)
+        if parts[:1] != ['files']:
+            return 404, error_body(404, 'notFound', 'Unknown endpoint'), 'application/json', {}
+
+        if len(parts) == 1:
+            kind = 'files.list'
+        elif len(parts) == 3 and parts[2] == 'export':
+            kind = 'files.export'
+        elif params.get('alt') == 'media':
+            kind = 'files.get_media'
+        else:
+            kind = 'files.get'
+        # Calls inside a batch are counted separately: they are API calls, but not HTTP round trips.
+        stat_kind = kind + '[batch]' if in_batch else kind
+        # Calls inside a batch can fail individually; the batch request itself carries the latency.
+        fail = drive.should_fail() if in_batch else drive.delay_and_maybe_fail()
+        if fail:
+            drive.count(stat_kind)
+            return 429, error_body(429, 'rateLimitExceeded', 'Rate Limit Exceeded'), 'application/json', {}
+
+        if kind == 'files.list':
+            page = drive.list_files(params.get('q'), int(params.get('pageSize', 100)), params.get('pageToken'))
+            drive.count(stat_kind)
+            return 200, json.dumps(page).encode('utf-8'), 'application/json', {}
+
+        file_id = urllib.parse.unquote(parts[1])
+        f = drive.files.get(file_id)
+        if f is None:
+            drive.count(stat_kind)
+            return 404, error_body(404, 'notFound', f'File not found: {file_id}.'), 'application/json', {}
+
+        if kind == 'files.get':
+            drive.count(stat_kind)
+            return 200, json.dumps(f).encode('utf-8'), 'application/json', {}
+        if kind == 'files.export':
+            if not f['mimeType'].startswith(GOOGLE_APPS_PREFIX):
+                drive.count(stat_kind)
+                return 403, error_body(403, 'fileNotExportable', 'Export only supports Docs Editors files.'), 'application/json', {}
+            body = file_content(content_key(f) + params.get('mimeType', ''), 0, drive.export_size)
+            drive.count(stat_kind, len(body))
+            return 200, body, params.get('mimeType', 'application/octet-stream'), {}
+
+        # files.get_media
+        size = int(f['size'])
+        start, end = 0, size
+        status, headers = 200, {}
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first or 0)
+            end = min(size, int(last) + 1) if last else size
+            if start >= size and size > 0:
+                drive.count(stat_kind)
+                return 416, b'', 'application/octet-stream', {'Content-Range': f'bytes */{size}'}
+            status, headers = 206, {'Content-Range': f'bytes {start}-{max(start, end - 1)}/{size}'}
+        body = file_content(content_key(f), start, end)
+        drive.count(stat_kind, len(body))
+        return status, body, 'application/octet-stream', headers
+
+    def handle_changes(self, parts, params, in_batch):
+        drive = self.drive
+        kind = 'changes.getStartPageToken' if parts[1:] == ['startPageToken'] else 'changes.list'
+        stat_kind = kind + '[batch]' if in_batch else kind
+        fail = drive.should_fail() if in_batch else drive.delay_and_maybe_fail()
+        drive.count(stat_kind)
+        if fail:
+            return 429, error_body(429, 'rateLimitExceeded', 'Rate Limit Exceeded'), 'application/json', {}
+        if kind == 'changes.getStartPageToken':
+            with drive.lock:
+                body = {'startPageToken': str(len(drive.changes))}
+        else:
+            body = drive.list_changes(int(params.get('pageSize', 100)), params.get('pageToken', '0'))
+        return 200, json.dumps(body).encode('utf-8'), 'application/json', {}
+
+    def handle_batch(self, content_type, body):
+        message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + content_type.encode('utf-8') + b'\r\n\r\n' + body)
+        boundary = 'batch_' + hashlib.md5(body).hexdigest()
+        out = []
+        for part in message.get_payload():
+            inner = part.get_payload()
+            request_line = inner.split('\n', 1)[0].strip()
+            method, target, _ = request_line.split(' ', 2)
+            status, response_body, response_type, _ = self.handle_api_get(urllib.parse.urlparse(target), in_batch=True)
+            content_id = part['Content-ID'][1:-1]
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {response_type}\r\n"
+                f"Content-Length: {len(response_body)}\r\n\r\n{response_body.decode('utf-8')}\r\n")
+        out.append(f"--{boundary}--\r\n")
+        self.send(200, ''.join(out).encode('utf-8'), f'multipart/mixed; boundary={boundary}')
+
+
+def make_server(drive, host='127.0.0.1', port=0):
+    handler = type('BoundDriveRequestHandler', (DriveRequestHandler,), {'drive': drive})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help="JSON file with {'files': [...]}.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help="0 picks a free port; the chosen one is printed.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every API call.")
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help="Extra random latency, uniform in [0, jitter].")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of calls answered with 429 rateLimitExceeded.")
+    parser.add_argument('--export-size', type=int, default=64 * 1024, help="Bytes returned by every export.")
+    args = parser.parse_args()
+
+    with open(args.model, 'r', encoding='utf-8') as f:
+        files = json.load(f)['files']
+    drive = FakeDrive(files, args.latency, args.latency_jitter, args.error_rate, args.export_size)
+    server = make_server(drive, args.host, args.port)
+    print(f"http://{server.server_address[0]}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
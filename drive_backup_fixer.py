@@ -1,8 +1,20 @@
 import os
-import io
+import argparse
 import json
 import datetime # For logging timestamp
+import hashlib
+import heapq
 import time     # For temporary filename uniqueness
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
@@ -15,28 +27,88 @@ LOCAL_BACKUP_PATH = "/path/to/your/local/google-drive-backup"  # !!! USER HAS SE
 DEMO_MODE = True  # SET TO False TO PERFORM ACTUAL FILE OPERATIONS AND DOWNLOADS
 
 SIZE_THRESHOLD_BYTES = 256
+CLASSIFY_PEEK_BYTES = 512 # Bytes read from each candidate to tell placeholders and shortcut files from files with real content.
+SKIP_FILES_WITH_CONTENT = False # True: small files with real content (not empty, not a shortcut) are never looked up on Drive.
+# Threads per stage of the repair pipeline (see "Repair Pipeline" below).
+EXTRACT_WORKERS = 2 # Reading Drive IDs out of shortcut files.
+RESOLVE_WORKERS = 2 # Looking placeholders up on Drive; each thread batches up to BATCH_REQUEST_SIZE ID lookups.
+DOWNLOAD_WORKERS = 4 # Downloading/exporting files smaller than LARGE_FILE_THRESHOLD_BYTES.
+LARGE_DOWNLOAD_WORKERS = 2 # Files of LARGE_FILE_THRESHOLD_BYTES or more download in their own lane, so they never hold up small ones.
+LARGE_FILE_THRESHOLD_BYTES = 64 * 1024 * 1024
+MAX_BYTES_IN_FLIGHT = 2 * 1024 * 1024 * 1024 # Cap on the (estimated) total size of all downloads running at once.
+DOWNLOAD_ORDER = "smallest_first" # Which waiting download starts next: "smallest_first", "directory" (folder by folder) or "fifo".
+PIPELINE_QUEUE_SIZE = 1000 # Max files waiting between two stages; keeps memory bounded on huge backups.
+BATCH_MAX_WAIT_SECONDS = 0.5 # How long a resolve thread waits for more IDs before sending a partial batch.
 EXCLUDED_EXTENSIONS = [".ini"] # e.g. [".ini", ".DS_Store"]
 LOST_FILES_LOG = "lost_or_failed_files.txt"
+STATE_DB_FILE = "drive_backup_fixer_state.sqlite3" # Remembers the outcome of every placeholder so interrupted runs can resume.
+RETRY_FAILED = False # Set to True to re-process placeholders that failed in an earlier run. Finished ones are always skipped.
+STATE_COMMIT_EVERY = 100 # Results are committed to the state database in batches of this many files.
+INCREMENTAL_MODE = False # True: skip the scan and only re-fetch files that changed on Drive since the last completed run.
+VERBOSE = False # True prints every file's details; False prints a progress line every PROGRESS_INTERVAL_SECONDS.
+PROGRESS_INTERVAL_SECONDS = 5
+EVENT_LOG_FILE = "drive_backup_fixer_events.jsonl" # One JSON event per line (lookups, downloads, errors). None disables it.
+RUN_SUMMARY_FILE = "drive_backup_fixer_summary.json" # Counters and latency histograms of the last run. None disables it.
+PROMETHEUS_TEXTFILE = None # e.g. "/var/lib/node_exporter/textfile_collector/drive_backup_fixer.prom"
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # Bytes fetched per request while downloading; also the peak memory per download.
+PARTIAL_DOWNLOAD_SUFFIX = ".fixer_partial" # In-progress downloads are written to hidden files with this suffix.
+DEDUPLICATE_DOWNLOADS = True # Fetch each Drive file (version, export format) once per run and link/copy it to other placeholders.
+DEDUPE_LINK_MODE = "hardlink" # First method tried for duplicates: "hardlink", "reflink" or "copy"; later ones are fallbacks.
+EXPORT_CACHE_DIR = "drive_backup_fixer_export_cache" # Keeps Google Docs/Sheets/Slides exports for reuse across runs. None disables it.
+EXPORT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024 # Least recently used exports are evicted beyond this size.
+DOWNLOAD_VERIFY_ATTEMPTS = 3 # Full downloads tried before a file whose size/MD5 does not match Drive is reported as failed.
+# Always skipped by the scanner: macOS metadata, placeholders this script already replaced, and its own temp files.
+INTERNAL_EXCLUDED_EXTENSIONS = {".ds_store", ".placeholder_original", PARTIAL_DOWNLOAD_SUFFIX}
+SCAN_WORKERS = 8 # Threads walking the top-level folders of the backup in parallel (helps most on network drives).
+SCAN_BATCH_SIZE = 256 # Files handed from a scan thread to the main thread at a time.
+SHARD_COUNT = 1 # >1 splits the backup into this many shards, each handled by its own process (see "Sharded Runs" below).
+SHARD_INDEX = None # 0..SHARD_COUNT-1 runs only that shard (e.g. one per host); None runs all shards on this machine.
+SHARD_CONSOLE_LOG = "drive_backup_fixer_console.log" # Console output of each shard started by a sharded run.
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
+BATCH_REQUEST_SIZE = 100 # Drive batch requests accept at most 100 calls each.
+
+# Drive API pacing, shared by all threads (see RequestGovernor).
+API_MAX_QPS = 20.0 # Sustained requests per second; each call inside a batch counts as one.
+API_BURST = 40 # Requests that may be sent at once after an idle period.
+API_MAX_CONCURRENCY = 16 # Upper bound for requests in flight; halved automatically on quota errors.
+API_MIN_CONCURRENCY = 1
+API_MAX_RETRIES = 6 # Retries for 429, 403 rate limit, 5xx and connection errors before giving up on a request.
+API_BACKOFF_BASE_SECONDS = 1.0 # Backoff before retry n is random between 0 and base * 2^n seconds...
+API_BACKOFF_MAX_SECONDS = 64.0 # ...capped at this.
+
+USE_DRIVE_INDEX = False # Crawl the whole Drive once and resolve placeholders from that index instead of per-file name queries.
+DRIVE_INDEX_FILE = 'drive_index.json'
+DRIVE_INDEX_MAX_AGE_HOURS = 24 # An on-disk index younger than this is reused; 0 always rebuilds it.
+
+SHORTCUT_EXTENSIONS = ['.gdoc', '.gsheet', '.gslides', '.gform', '.gdraw', '.gtable', '.gjam']
+SHORTCUT_ID_KEYS = ['doc_id', 'file_id', 'id', 'resource_id'] # Keys that hold the Drive ID in a shortcut file's JSON
+DRIVE_FILE_FIELDS = "id, name, mimeType, capabilities(canDownload), shared, owners, parents,webViewLink, size, md5Checksum, version, modifiedTime"
+DRIVE_INDEX_FIELDS = "id, name, mimeType, capabilities(canDownload), parents, webViewLink, size, md5Checksum, version, modifiedTime" # What downloads, verification and path rebuilding need.
+CHANGES_FIELDS = f"nextPageToken, newStartPageToken, changes(fileId, removed, file({DRIVE_FILE_FIELDS}, trashed))"
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
 
 EXPORT_MIMETYPES = {
     'application/vnd.google-apps.document': {
         'mimeType': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        'extension': '.docx'
+        'extension': '.docx',
+        'estimated_size': 2 * 1024 * 1024 # Drive reports no size for these; used to schedule the export
     },
     'application/vnd.google-apps.spreadsheet': {
         'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        'extension': '.xlsx'
+        'extension': '.xlsx',
+        'estimated_size': 10 * 1024 * 1024 # Drive's export size limit: big sheets are slow to render
     },
     'application/vnd.google-apps.presentation': {
         'mimeType': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-        'extension': '.pptx'
+        'extension': '.pptx',
+        'estimated_size': 10 * 1024 * 1024
     },
     'application/vnd.google-apps.drawing': {
         'mimeType': 'image/png',
-        'extension': '.png'
+        'extension': '.png',
+        'estimated_size': 1024 * 1024
     },
 }
 
@@ -47,8 +119,8 @@ def check_write_permissions(directory_path):
         print(f"Error: Write check failed. Path '{directory_path}' is not a directory.")
         return False
     
-    # More unique temp filename
-    temp_filename = os.path.join(directory_path, f".script_write_test_{int(time.time())}.tmp")
+    # More unique temp filename (the processes of a sharded run all check at the same moment)
+    temp_filename = os.path.join(directory_path, f".script_write_test_{int(time.time())}.{os.getpid()}.{threading.get_ident()}.tmp")
     try:
         with open(temp_filename, 'w') as f:
             f.write("test_write_permissions")
@@ -65,9 +137,232 @@ def check_write_permissions(directory_path):
              print("       If locked on macOS, you may need to use 'chflags -R nouchg \"your_backup_path\"' in Terminal.")
         return False
 
-# (get_drive_service, find_small_files, get_id_from_google_shortcut_file, search_drive_file remain largely the same)
+# --- Console Output ---
+_print_lock = threading.Lock()
+_log_state = threading.local()
+
+def log(message=""):
+    """Prints a message, or collects it if the current thread is buffering output for one file."""
+    buffer = getattr(_log_state, 'buffer', None)
+    if buffer is not None:
+        buffer.append(message)
+    else:
+        with _print_lock:
+            print(message)
+
+def call_with_buffered_log(func, *args, **kwargs):
+    """Runs func and returns (result, lines) with everything it logged collected instead of printed."""
+    previous = getattr(_log_state, 'buffer', None)
+    _log_state.buffer = []
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        lines, _log_state.buffer = _log_state.buffer, previous
+    return result, lines
+
+def flush_log(lines):
+    """Prints a block of buffered lines in one go so output from parallel workers does not interleave."""
+    if lines:
+        with _print_lock:
+            print("\n".join(lines))
+
+# --- Instrumentation ---
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Histogram:
+    """Cumulative-bucket latency histogram (Prometheus style)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bucket bound below which a fraction q of the observations fall (None if empty)."""
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 3),
+                'mean': round(self.sum / self.count, 3) if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'bucket_counts': list(self.counts)} # Lets the summaries of several shards be added up
+
+class Metrics:
+    """Counters, latency histograms and the JSON-lines event log of one run, shared by all threads."""
+
+    def __init__(self, event_log_path=None):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.finished = None # Only set for merged shard summaries; a live run lasts until now
+        self.api = None # API counts of merged shard summaries; a live run reports its own RequestGovernor
+        self.event_log = open(event_log_path, 'a', encoding='utf-8') if event_log_path else None
+
+    @classmethod
+    def from_summaries(cls, summaries):
+        """Adds up the run summaries of several shards (see write_summary) into one Metrics."""
+        metrics = cls()
+        metrics.api = {}
+        spans = []
+        for summary in summaries:
+            started = datetime.datetime.fromisoformat(summary['started_at']).timestamp()
+            spans.append((started, started + summary['duration_seconds']))
+            for name, value in summary['counters'].items():
+                metrics.counters[name] = metrics.counters.get(name, 0) + value
+            for name, data in summary['latency_seconds'].items():
+                histogram = metrics.histograms.setdefault(name, Histogram())
+                histogram.counts = [a + b for a, b in zip(histogram.counts, data['bucket_counts'])]
+                histogram.count += data['count']
+                histogram.sum += data['sum']
+            for name in ('requests', 'retries', 'quota_errors'): # Counts add up; each shard's concurrency limit does not
+                metrics.api[name] = metrics.api.get(name, 0) + summary['api'].get(name, 0)
+        if spans:
+            metrics.started = min(start for start, _ in spans)
+            metrics.finished = max(end for _, end in spans)
+        return metrics
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def value(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+
+    def emit(self, event, **fields):
+        """Appends one event to the event log (buffered; flushed on close)."""
+        if self.event_log is None:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}, default=str)
+        with self.lock:
+            self.event_log.write(line + "\n")
+
+    def summary(self):
+        with self.lock:
+            summary = {
+                'started_at': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                'duration_seconds': round((self.finished or time.time()) - self.started, 3),
+                'counters': dict(self.counters),
+                'latency_seconds': {name: h.to_dict() for name, h in self.histograms.items()},
+            }
+        if self.api is not None:
+            summary['api'] = dict(self.api)
+            return summary
+        governor = get_governor()
+        summary['api'] = {'requests': governor.requests, 'retries': governor.retries, 'quota_errors': governor.throttled,
+                          'concurrency_limit': int(governor.concurrency_limit)}
+        return summary
+
+    def write_summary(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path):
+        """Writes all metrics in the Prometheus text format (for node_exporter's textfile collector)."""
+        summary = self.summary()
+        lines = []
+        def add(name, value, kind, labels=""):
+            if kind:
+                lines.append(f"# TYPE drive_backup_fixer_{name} {kind}")
+            lines.append(f"drive_backup_fixer_{name}{labels} {value}")
+        for name, value in sorted(summary['counters'].items()):
+            add(f"{name}_total", value, 'counter')
+        for name, value in sorted(summary['api'].items()):
+            add(f"api_{name}", value, 'gauge')
+        add("duration_seconds", summary['duration_seconds'], 'gauge')
+        with self.lock:
+            histograms = {name: (h.buckets, list(h.counts), h.count, h.sum) for name, h in self.histograms.items()}
+        for name, (buckets, counts, count, total) in sorted(histograms.items()):
+            lines.append(f"# TYPE drive_backup_fixer_{name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                add(f"{name}_bucket", cumulative, None, f'{{le="{bound}"}}')
+            add(f"{name}_sum", round(total, 6), None)
+            add(f"{name}_count", count, None)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path) # node_exporter must never see a half-written file
+
+    def close(self):
+        with self.lock:
+            if self.event_log is not None:
+                self.event_log.close()
+                self.event_log = None
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_metrics():
+    """Returns the Metrics of the current run, creating it (and opening EVENT_LOG_FILE) on first use."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(EVENT_LOG_FILE)
+        return _metrics
+
+def error_class(error_msg):
+    """Short machine-readable category for a failure, used in events, counters and results.
+
+    Matches on how the message starts, and expects the bare error message rather than a full report
+    line: file names and paths further in (e.g. "FOLDER plan.pdf") must not decide the category.
+    """
+    error_msg = error_msg or ""
+    for prefix, category in (("Reason: Not found", 'not_found'), ("Reason: Placeholder linked to a FOLDER", 'folder'),
+                             ("File too large", 'export_too_large'), ("Google Form", 'unsupported_type'),
+                             ("Cannot export", 'unsupported_type'), ("API error", 'api_error'),
+                             ("Download/Export API Error", 'api_error'), ("OS error", 'local_io_error'),
+                             ("Unexpected", 'unexpected'), ("Reason: Unexpected", 'unexpected'), ("Checksum", 'checksum_mismatch')):
+        if error_msg.startswith(prefix):
+            return category
+    return 'other'
+
+class ProgressView:
+    """The default console output: one status line at most every PROGRESS_INTERVAL_SECONDS."""
+
+    def __init__(self):
+        self.last_print = 0.0
+
+    def update(self, done, ok, failed, scan_stats, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_print < PROGRESS_INTERVAL_SECONDS:
+            return
+        self.last_print = now
+        metrics = get_metrics()
+        elapsed = max(0.001, time.time() - metrics.started)
+        downloaded_mb = metrics.value('bytes_downloaded') / (1024 * 1024)
+        governor = get_governor()
+        log(f"[{datetime.timedelta(seconds=int(elapsed))}] scanned {scan_stats['candidates']} candidates "
+            f"({scan_stats['skipped']} already done) | processed {done}: {ok} ok, {failed} failed | "
+            f"{done / elapsed:.1f} files/s | {downloaded_mb:.1f} MB | API {governor.requests} calls, "
+            f"{governor.retries} retries")
+
 # --- Google Drive Authentication ---
-def get_drive_service():
+def get_credentials():
     creds = None
     if os.path.exists(TOKEN_FILE):
         creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
@@ -83,8 +378,15 @@ def get_drive_service():
             creds = flow.run_local_server(port=0)
         with open(TOKEN_FILE, 'w') as token:
             token.write(creds.to_json())
+    return creds
+
+def build_drive_client(creds):
+    """Builds a Drive v3 client. Kept separate so benchmarks can point it at a local stand-in server."""
+    return build('drive', 'v3', credentials=creds)
+
+def get_drive_service(creds):
     try:
-        service = build('drive', 'v3', credentials=creds)
+        service = build_drive_client(creds)
         print("Successfully connected to Google Drive API.")
         return service
     except HttpError as error:
@@ -93,80 +395,507 @@ def get_drive_service():
         print(f"An unexpected error occurred during Drive service build: {e}")
     return None
 
+_worker_state = threading.local()
+
+def get_worker_drive_service(creds):
+    """Returns a Drive service owned by the calling thread.
+
+    The client returned by build() wraps a single httplib2 connection and is not
+    thread-safe, so every worker thread builds (once) and reuses its own.
+    """
+    service = getattr(_worker_state, 'service', None)
+    if service is None:
+        service = build_drive_client(creds)
+        _worker_state.service = service
+    return service
+
+# --- Drive API Rate Limiting ---
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+def is_retryable_error(error):
+    """True for HttpErrors worth retrying: 429, 5xx, and 403 rate limit errors."""
+    if not isinstance(error, HttpError):
+        return isinstance(error, (ConnectionError, TimeoutError, socket.timeout))
+    status = error.resp.status
+    return status in RETRYABLE_STATUS_CODES or (status == 403 and any(r in str(error.content) for r in RATE_LIMIT_REASONS))
+
+def is_quota_error(error):
+    """True if Drive is telling us to slow down (as opposed to a transient server error)."""
+    return isinstance(error, HttpError) and (
+        error.resp.status == 429 or (error.resp.status == 403 and any(r in str(error.content) for r in RATE_LIMIT_REASONS)))
+
+class RequestGovernor:
+    """Paces every Drive API request made by the script, shared by all threads.
+
+    * A token bucket keeps the request rate at API_MAX_QPS (bursts up to API_BURST).
+    * Retryable errors (429, 403 rate limits, 5xx, dropped connections) are retried with
+      exponential backoff and full jitter, up to API_MAX_RETRIES times.
+    * The number of requests in flight adapts AIMD-style: it grows by roughly one per round of
+      successful requests and halves (at most once per second) when quota errors show up.
+    """
+
+    def __init__(self, max_qps, burst, min_concurrency, max_concurrency):
+        self.max_qps = max_qps
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.rate_wait_seconds = 0.0
+
+    def _acquire(self, cost):
+        with self.condition:
+            started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.max_qps)
+                self.last_refill = now
+                # A cost above the bucket size (e.g. a 100-call batch) is let through once the bucket
+                # is full and paid off as debt by later callers.
+                if self.in_flight < int(self.concurrency_limit) and self.tokens >= min(cost, self.burst):
+                    break
+                wait = 0.05 if self.in_flight >= int(self.concurrency_limit) else (min(cost, self.burst) - self.tokens) / self.max_qps
+                self.condition.wait(timeout=wait)
+            self.tokens -= cost
+            self.in_flight += 1
+            self.requests += cost
+            self.rate_wait_seconds += time.monotonic() - started
+
+    def _release(self, quota_error=False):
+        with self.condition:
+            self.in_flight -= 1
+            if quota_error:
+                self.report_quota_error()
+            else:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            self.condition.notify_all()
+
+    def report_quota_error(self):
+        """Counts a quota error and halves the concurrency limit (at most once per second)."""
+        with self.condition:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self.last_decrease >= 1.0:
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                self.last_decrease = now
+
+    def backoff(self, attempt):
+        """Sleeps before retry number `attempt` (0-based): full jitter over an exponentially growing window."""
+        with self.condition:
+            self.retries += 1
+        time.sleep(random.uniform(0, min(API_BACKOFF_MAX_SECONDS, API_BACKOFF_BASE_SECONDS * (2 ** attempt))))
+
+    def call(self, func, cost=1):
+        """Calls func() (one API request, or `cost` requests for a batch) under the rate and
+        concurrency limits, retrying retryable errors. The last error is re-raised."""
+        attempt = 0
+        while True:
+            self._acquire(cost)
+            try:
+                result = func()
+            except Exception as e:
+                self._release(quota_error=is_quota_error(e))
+                if not is_retryable_error(e) or attempt >= API_MAX_RETRIES:
+                    raise
+                log(f"    Retryable API error ({e.resp.status if isinstance(e, HttpError) else type(e).__name__}), "
+                    f"retry {attempt + 1}/{API_MAX_RETRIES}.")
+                self.backoff(attempt)
+                attempt += 1
+                continue
+            self._release()
+            return result
+
+    def execute(self, request, cost=1):
+        """Governed request.execute()."""
+        return self.call(request.execute, cost)
+
+    def summary(self):
+        return (f"Drive API: {self.requests} requests, {self.retries} retries, {self.throttled} quota errors, "
+                f"{self.rate_wait_seconds:.1f}s waited for a request slot (summed over threads), "
+                f"concurrency limit now {int(self.concurrency_limit)}.")
+
+_governor = None
+_governor_lock = threading.Lock()
+
+def get_governor():
+    """Returns the RequestGovernor shared by all threads, creating it from the settings on first use."""
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = RequestGovernor(API_MAX_QPS, API_BURST, API_MIN_CONCURRENCY, API_MAX_CONCURRENCY)
+        return _governor
+
 # --- Local File Operations ---
-def find_small_files(backup_path, threshold, excluded_exts):
-    small_files = []
-    for root, _, files in os.walk(backup_path):
-        for filename in files:
-            filepath = os.path.join(root, filename)
+def _small_file_stat(entry, threshold, excluded, select=None):
+    """Returns the stat of a DirEntry if it is a regular, non-excluded file below threshold
+    (and accepted by select, if given), else None."""
+    if not entry.is_file(follow_symlinks=False): # Also rules out symlinks, usually without a syscall
+        return None
+    if os.path.splitext(entry.name)[1].lower() in excluded:
+        return None
+    if select is not None and not select(entry.path): # Checked before the stat, so other shards' files cost none
+        return None
+    st = entry.stat(follow_symlinks=False) # Cached on the DirEntry (free on Windows, one lstat elsewhere)
+    return st if st.st_size < threshold else None
+
+def _walk_small_files(top, threshold, excluded, select=None, stop=None):
+    """Yields (filepath, stat_result) for small files below top, using os.scandir depth-first.
+    Returns early, before listing the next directory, once the `stop` event is set."""
+    stack = [top]
+    while stack:
+        if stop is not None and stop.is_set():
+            return
+        dirpath = stack.pop()
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            continue
+                        st = _small_file_stat(entry, threshold, excluded, select)
+                        if st is not None:
+                            yield entry.path, st
+                    except OSError as e:
+                        log(f"Warning: Could not access or get size of {entry.path}: {e}")
+        except OSError as e:
+            log(f"Warning: Could not list directory {dirpath}: {e}")
+
+def scan_small_files(backup_path, threshold, excluded_exts, workers=None, select=None, stop=None):
+    """Yields (filepath, stat_result) for every candidate placeholder under backup_path.
+
+    Each top-level folder is walked by its own thread (up to `workers`, default SCAN_WORKERS)
+    and results are streamed through a bounded queue, so the caller can start on the first
+    files while the scan is still running. `select`, if given, is called with each path
+    and limits the scan to the paths it accepts (see shard_selector). Setting the `stop`
+    event ends the scan within one directory per walker, even if no files are being found.
+    """
+    workers = SCAN_WORKERS if workers is None else workers
+    excluded = {ext.lower() for ext in excluded_exts} | INTERNAL_EXCLUDED_EXTENSIONS
+
+    top_dirs = []
+    try:
+        with os.scandir(backup_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        top_dirs.append(entry.path)
+                        continue
+                    st = _small_file_stat(entry, threshold, excluded, select)
+                    if st is not None:
+                        yield entry.path, st
+                except OSError as e:
+                    log(f"Warning: Could not access or get size of {entry.path}: {e}")
+    except OSError as e:
+        log(f"Warning: Could not list directory {backup_path}: {e}")
+        return
+
+    if workers <= 1 or len(top_dirs) <= 1:
+        for top in top_dirs:
+            yield from _walk_small_files(top, threshold, excluded, select, stop)
+        return
+
+    results = queue.Queue(maxsize=workers * 4)
+    closing = threading.Event() # Set once this generator is done, for whatever reason
+
+    def put(item):
+        while not closing.is_set():
             try:
-                if os.path.isfile(filepath) and not os.path.islink(filepath):
-                    filesize = os.path.getsize(filepath)
-                    _, ext = os.path.splitext(filename)
-                    # Add .DS_Store to common exclusions for macOS if not already there
-                    common_excluded = excluded_exts + [".ds_store"]
-                    if filesize < threshold and ext.lower() not in common_excluded:
-                        small_files.append(filepath)
-            except OSError as e:
-                print(f"Warning: Could not access or get size of {filepath}: {e}")
-    return small_files
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def walk(top):
+        batch = []
+        try:
+            for item in _walk_small_files(top, threshold, excluded, select, closing):
+                if closing.is_set():
+                    return
+                batch.append(item)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    put(batch)
+                    batch = []
+            if batch:
+                put(batch)
+        finally:
+            put(None) # Marks this folder as done
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    for top in top_dirs:
+        executor.submit(walk, top)
+    remaining = len(top_dirs)
+    try:
+        while remaining:
+            if stop is not None and stop.is_set():
+                return
+            try:
+                batch = results.get(timeout=0.1)
+            except queue.Empty:
+                continue # Nothing found for a while (e.g. a big folder of large files); check `stop` again
+            if batch is None:
+                remaining -= 1
+            else:
+                yield from batch
+    finally:
+        closing.set() # Lets the walkers exit if the caller stops early
+        executor.shutdown(wait=False)
+
+def find_small_files(backup_path, threshold, excluded_exts):
+    """Yields the paths of all candidate placeholders under backup_path (see scan_small_files)."""
+    for filepath, _ in scan_small_files(backup_path, threshold, excluded_exts):
+        yield filepath
 
 def get_id_from_google_shortcut_file(filepath):
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
             data = json.load(f)
-            possible_keys = ['doc_id', 'file_id', 'id', 'resource_id']
-            for key in possible_keys:
+            for key in SHORTCUT_ID_KEYS:
                 if key in data and isinstance(data[key], str):
                     return data[key]
-            print(f"  Could not find a known ID key in JSON of {filepath}. Data: {data}")
+            log(f"  Could not find a known ID key in JSON of {filepath}. Data: {data}")
     except json.JSONDecodeError:
-        print(f"  {filepath} is not a valid JSON file (or not a Google shortcut). Cannot extract ID.")
+        log(f"  {filepath} is not a valid JSON file (or not a Google shortcut). Cannot extract ID.")
     except IOError as e:
-        print(f"  Could not read {filepath} to extract ID: {e}")
+        log(f"  Could not read {filepath} to extract ID: {e}")
     except Exception as e:
-        print(f"  Unexpected error parsing shortcut {filepath} for ID: {e}")
+        log(f"  Unexpected error parsing shortcut {filepath} for ID: {e}")
     return None
 
+def classify_small_file(filepath):
+    """Tells what a candidate is from its first CLASSIFY_PEEK_BYTES, without any network access.
+
+    Returns 'empty' (zero bytes or only whitespace: a typical placeholder), 'shortcut' (Google
+    shortcut JSON with a Drive ID, whatever its extension) or 'content' (a small file with real content).
+    """
+    with open(filepath, 'rb') as f:
+        head = f.read(CLASSIFY_PEEK_BYTES)
+    stripped = head.strip()
+    if not stripped:
+        return 'empty'
+    # Only keys specific to Google shortcuts count here: plenty of ordinary JSON files have an "id".
+    if stripped.startswith(b'{') and (b'"doc_id"' in head or b'"resource_id"' in head or b'docs.google.com' in head):
+        return 'shortcut'
+    return 'content'
+
 # --- Google Drive Operations ---
 def search_drive_file(service, file_id=None, filename=None):
     try:
         if file_id:
-            print(f"  Searching Drive for file ID: {file_id}")
-            file_metadata = service.files().get(
+            log(f"  Searching Drive for file ID: {file_id}")
+            file_metadata = get_governor().execute(service.files().get(
                 fileId=file_id,
-                fields="id, name, mimeType, capabilities(canDownload), shared, owners, parents,webViewLink"
-            ).execute()
+                fields=DRIVE_FILE_FIELDS
+            ))
             return file_metadata
         elif filename:
-            print(f"  Searching Drive for filename: '{filename}' (this can be ambiguous)")
+            log(f"  Searching Drive for filename: '{filename}' (this can be ambiguous)")
             query_filename = filename.replace("'", "\\'")
             query = f"name = '{query_filename}' and trashed = false"
-            results = service.files().list(
+            results = get_governor().execute(service.files().list(
                 q=query,
                 spaces='drive',
-                fields='files(id, name, mimeType, capabilities(canDownload), shared, owners, parents,webViewLink)',
+                fields=f'files({DRIVE_FILE_FIELDS})',
                 pageSize=10 # Be careful with pageSize if ambiguity is high
-            ).execute()
+            ))
             items = results.get('files', [])
             if not items:
-                print(f"  No file found with name '{filename}'.")
+                log(f"  No file found with name '{filename}'.")
                 return None
             if len(items) > 1:
-                print(f"  Warning: Found {len(items)} files named '{filename}'. Using the first one found: {items[0].get('name')} (ID: {items[0].get('id')})")
+                log(f"  Warning: Found {len(items)} files named '{filename}'. Using the first one found: {items[0].get('name')} (ID: {items[0].get('id')})")
             return items[0]
     except HttpError as error:
         # Specifically check for 404 when searching by ID
         if file_id and error.resp.status == 404:
-            print(f"  File with ID '{file_id}' not found on Google Drive (404 Error).")
+            log(f"  File with ID '{file_id}' not found on Google Drive (404 Error).")
         else:
-            print(f"  API Error searching for file ({file_id or filename}): {error}")
+            log(f"  API Error searching for file ({file_id or filename}): {error}")
     except Exception as e:
-        print(f"  Unexpected error searching for file ({file_id or filename}): {e}")
+        log(f"  Unexpected error searching for file ({file_id or filename}): {e}")
     return None
 
 
-def download_drive_file(service, drive_file_metadata, local_placeholder_path):
+def batch_get_drive_files(service, file_ids):
+    """Fetches metadata for many file IDs using Drive batch requests (BATCH_REQUEST_SIZE calls each).
+
+    Returns {file_id: (metadata, error_msg)}. 404s and other per-item errors are reported
+    with metadata None; IDs of a batch that failed as a whole are left out so the caller can
+    fall back to looking them up one by one.
+    """
+    results = {}
+    unique_ids = list(dict.fromkeys(file_ids))
+    governor = get_governor()
+
+    for start in range(0, len(unique_ids), BATCH_REQUEST_SIZE):
+        to_fetch = unique_ids[start:start + BATCH_REQUEST_SIZE]
+        attempt = 0
+        while to_fetch:
+            retry_ids = []
+
+            def on_response(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = (response, None)
+                elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                    results[request_id] = (None, f"File with ID '{request_id}' not found on Google Drive (404 Error).")
+                elif is_retryable_error(exception) and attempt < API_MAX_RETRIES:
+                    retry_ids.append(request_id)
+                else:
+                    results[request_id] = (None, f"API Error searching for file ({request_id}): {exception}")
+
+            batch = service.new_batch_http_request(callback=on_response)
+            for file_id in to_fetch:
+                batch.add(service.files().get(fileId=file_id, fields=DRIVE_FILE_FIELDS), request_id=file_id)
+            try:
+                governor.execute(batch, cost=len(to_fetch))
+            except HttpError as error:
+                log(f"  API Error executing batch lookup of {len(to_fetch)} file IDs: {error}. They will be looked up individually.")
+                break
+            except Exception as e:
+                log(f"  Unexpected error executing batch lookup of {len(to_fetch)} file IDs: {e}. They will be looked up individually.")
+                break
+            if retry_ids:
+                # Rate-limited items inside a batch: back off, then send just those again.
+                governor.report_quota_error()
+                log(f"  {len(retry_ids)} of {len(to_fetch)} batched lookups were rate limited, retry {attempt + 1}/{API_MAX_RETRIES}.")
+                governor.backoff(attempt)
+                attempt += 1
+            to_fetch = retry_ids
+    return results
+
+def download_ranges(request, f, position, md5):
+    """Appends the bytes of a get_media request from `position` on to f, one DOWNLOAD_CHUNK_SIZE
+    Range request at a time, feeding them to md5. Returns the (possibly restarted) md5."""
+    def fetch_range(headers):
+        # Raised here, inside the governed call, so rate limits and 5xx are retried and slow the governor down.
+        resp, content = request.http.request(request.uri, headers=headers)
+        if resp.status not in (200, 206, 416):
+            raise HttpError(resp, content, uri=request.uri)
+        return resp, content
+
+    total_size = None
+    while total_size is None or position < total_size:
+        headers = {'range': f"bytes={position}-{position + DOWNLOAD_CHUNK_SIZE - 1}"}
+        resp, content = get_governor().call(lambda: fetch_range(headers))
+        if resp.status == 416: # Nothing left after `position`: the partial file is already complete
+            break
+        if resp.status == 200 and position: # The server ignored the Range header and sent the whole file
+            f.truncate(0)
+            md5, position = hashlib.md5(), 0
+        f.write(content)
+        md5.update(content)
+        position += len(content)
+        if 'content-range' in resp:
+            total_size = int(resp['content-range'].rsplit('/', 1)[1])
+        else:
+            total_size = position
+        if not content:
+            break
+        log(f"    Download {int(position * 100 / total_size) if total_size else 100}%.")
+    return md5
+
+def download_resumable(request, drive_file_metadata, partial_path, reload_metadata=None):
+    """Downloads a get_media request into partial_path, resuming from whatever an earlier attempt left there.
+
+    Returns None once the file matches the size and md5Checksum Drive reports for it, or an error
+    message if it still does not after DOWNLOAD_VERIFY_ATTEMPTS downloads. On the first mismatch the
+    metadata is read again with reload_metadata(), if given, in case the file changed on Drive since
+    it was looked up (e.g. in an older Drive index). API and OS errors are raised and leave the
+    partial file in place for the next attempt.
+    """
+    expected_size = int(drive_file_metadata['size']) if drive_file_metadata.get('size') is not None else None
+    expected_md5 = drive_file_metadata.get('md5Checksum')
+    for attempt in range(1, DOWNLOAD_VERIFY_ATTEMPTS + 1):
+        md5 = hashlib.md5()
+        with open(partial_path, 'ab+') as f:
+            f.seek(0)
+            for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                md5.update(block)
+            if f.tell():
+                log(f"    Resuming download at byte {f.tell()} from '{partial_path}'.")
+                get_metrics().inc('bytes_resumed', f.tell())
+            md5 = download_ranges(request, f, f.tell(), md5)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        if (expected_size is None or size == expected_size) and (expected_md5 is None or md5.hexdigest() == expected_md5):
+            if expected_md5: log(f"    Verified size and MD5 checksum ({expected_md5}).")
+            return None
+        if reload_metadata is not None:
+            current = reload_metadata()
+            reload_metadata = None
+            if current and (current.get('size'), current.get('md5Checksum')) != (drive_file_metadata.get('size'), expected_md5):
+                log("    The file changed on Drive since it was looked up; checking against its current size and MD5.")
+                expected_size = int(current['size']) if current.get('size') is not None else None
+                expected_md5 = current.get('md5Checksum')
+                if (expected_size is None or size == expected_size) and (expected_md5 is None or md5.hexdigest() == expected_md5):
+                    if expected_md5: log(f"    Verified size and MD5 checksum ({expected_md5}).")
+                    return None
+        log(f"    Downloaded data does not match Drive (size {size}, expected {expected_size}; MD5 {md5.hexdigest()}, "
+            f"expected {expected_md5}). Discarding it (attempt {attempt}/{DOWNLOAD_VERIFY_ATTEMPTS}).")
+        get_metrics().inc('checksum_mismatches')
+        os.remove(partial_path)
+    return f"Checksum mismatch after {DOWNLOAD_VERIFY_ATTEMPTS} download attempts"
+
+LINK_METHODS = ("hardlink", "reflink", "copy")
+FICLONE = 0x40049409 # Linux ioctl that makes a copy-on-write clone of a file (Btrfs, XFS, ...)
+
+def reflink_file(source_path, dest_path):
+    """Creates dest_path as a copy-on-write clone of source_path. Raises OSError where that is not supported."""
+    if sys.platform.startswith('linux'):
+        import fcntl # Not available on Windows
+        with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    elif sys.platform == 'darwin':
+        if subprocess.run(['cp', '-c', source_path, dest_path], capture_output=True).returncode != 0:
+            raise OSError(f"cp -c could not clone '{source_path}'")
+    else:
+        raise OSError("reflinks are not supported on this platform")
+
+def materialize_copy(source_path, dest_path, first_method=None):
+    """Makes dest_path a hardlink, reflink or copy of source_path, starting with first_method (DEDUPE_LINK_MODE by default).
+
+    Like downloads, the new file is created under a hidden temporary name and then moved into place.
+    Returns the method that worked.
+    """
+    temp_path = os.path.join(os.path.dirname(dest_path),
+                             f".{os.path.basename(dest_path)}.{os.getpid()}.{threading.get_ident()}{PARTIAL_DOWNLOAD_SUFFIX}")
+    first_method = first_method or DEDUPE_LINK_MODE
+    methods = LINK_METHODS[LINK_METHODS.index(first_method):] if first_method in LINK_METHODS else ("copy",)
+    for method in methods:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        try:
+            if method == "hardlink":
+                os.link(source_path, temp_path)
+            elif method == "reflink":
+                reflink_file(source_path, temp_path)
+            else:
+                shutil.copyfile(source_path, temp_path)
+                with open(temp_path, 'rb+') as f:
+                    os.fsync(f.fileno())
+            os.replace(temp_path, dest_path)
+            return method
+        except OSError as e:
+            if os.path.exists(temp_path): os.remove(temp_path)
+            if method == methods[-1]:
+                raise
+            log(f"    Could not create a {method} ({e}), trying the next method.")
+
+def download_drive_file(service, drive_file_metadata, local_placeholder_path, replace_existing=False, copy_from=None,
+                        copy_method=None):
+    """Downloads or exports a Drive file next to the placeholder, which is renamed to *.placeholder_original.
+    With replace_existing, local_placeholder_path is a file downloaded earlier and is overwritten in place.
+    With copy_from, the file was already fetched to that path (earlier in this run, or into the export
+    cache) and is linked or copied from there, starting with copy_method, instead of being downloaded again.
+    Returns (local path, None) on success, otherwise (None, reason)."""
     file_id = drive_file_metadata['id']
     original_drive_name = drive_file_metadata['name']
     drive_mime_type = drive_file_metadata['mimeType']
@@ -182,7 +911,7 @@ def download_drive_file(service, drive_file_metadata, local_placeholder_path):
         message = (f"  File '{original_drive_name}' (ID: {file_id}) is a Google Form. "
                    f"Google Forms cannot be directly exported to a simple file format by this script. "
                    f"Consider linking responses to a Google Sheet for backup, or use Google Takeout.")
-        print(message)
+        log(message)
         return None, "Google Form (unsupported for useful export by this script)"
 
     if drive_mime_type in EXPORT_MIMETYPES:
@@ -191,108 +920,1163 @@ def download_drive_file(service, drive_file_metadata, local_placeholder_path):
         new_extension = export_details['extension']
         base_name, _ = os.path.splitext(original_drive_name)
         new_filename_on_disk = base_name + new_extension
-        print(f"  File is a Google Workspace type. Preparing to export '{original_drive_name}' as {new_filename_on_disk} ({export_mime_type}).")
+        log(f"  File is a Google Workspace type. Preparing to export '{original_drive_name}' as {new_filename_on_disk} ({export_mime_type}).")
         try:
             request = service.files().export_media(fileId=file_id, mimeType=export_mime_type)
             is_export = True
         except HttpError as e:
             if e.resp.status == 403 and "exportSizeLimitExceeded" in str(e.content):
-                 print(f"  API Error: File '{original_drive_name}' (ID: {file_id}) is too large to be exported by the API.")
+                 log(f"  API Error: File '{original_drive_name}' (ID: {file_id}) is too large to be exported by the API.")
                  return None, "File too large for API export"
-            print(f"  API error preparing export for {file_id} ({original_drive_name}): {e}")
+            log(f"  API error preparing export for {file_id} ({original_drive_name}): {e}")
             return None, f"API error during export prep ({e.resp.status})"
 
     elif 'application/vnd.google.colaboratory' == drive_mime_type and can_download_directly:
-        print(f"  File '{original_drive_name}' is a Google Colaboratory file. Preparing to download directly (as .ipynb).")
+        log(f"  File '{original_drive_name}' is a Google Colaboratory file. Preparing to download directly (as .ipynb).")
         new_filename_on_disk = original_drive_name if original_drive_name.lower().endswith('.ipynb') else original_drive_name + '.ipynb'
         try:
             request = service.files().get_media(fileId=file_id)
         except HttpError as e:
-            print(f"  API error preparing Colab download for {file_id} ({original_drive_name}): {e}")
+            log(f"  API error preparing Colab download for {file_id} ({original_drive_name}): {e}")
             return None, f"API error during Colab download prep ({e.resp.status})"
 
     elif can_download_directly:
-        print(f"  File '{original_drive_name}' (Type: {drive_mime_type}) is a standard file. Preparing to download directly.")
+        log(f"  File '{original_drive_name}' (Type: {drive_mime_type}) is a standard file. Preparing to download directly.")
         try:
             request = service.files().get_media(fileId=file_id)
         except HttpError as e:
-            print(f"  API error preparing direct download for {file_id} ({original_drive_name}): {e}")
+            log(f"  API error preparing direct download for {file_id} ({original_drive_name}): {e}")
             return None, f"API error during direct download prep ({e.resp.status})"
     else:
         message = (f"  File '{original_drive_name}' (ID: {file_id}, Type: {drive_mime_type}) "
                    f"cannot be exported with current rules and direct download is not permitted/possible.")
-        print(message)
+        log(message)
         return None, "Cannot export with defined rules and not directly downloadable"
 
     if request:
-        new_filepath = os.path.join(local_dir, new_filename_on_disk)
-        if os.path.exists(new_filepath) and new_filepath.lower() != local_placeholder_path.lower():
+        new_filepath = local_placeholder_path if replace_existing else os.path.join(local_dir, new_filename_on_disk)
+        if not replace_existing and os.path.exists(new_filepath) and new_filepath.lower() != local_placeholder_path.lower():
             if DEMO_MODE:
-                 print(f"  [DEMO MODE] A file named '{new_filename_on_disk}' already exists in '{local_dir}'. Would append '_downloaded'.")
+                 log(f"  [DEMO MODE] A file named '{new_filename_on_disk}' already exists in '{local_dir}'. Would append '_downloaded'.")
             else:
-                print(f"  Warning: A file named '{new_filename_on_disk}' already exists in '{local_dir}'. Appending '_downloaded'.")
+                log(f"  Warning: A file named '{new_filename_on_disk}' already exists in '{local_dir}'. Appending '_downloaded'.")
                 base, ext = os.path.splitext(new_filename_on_disk)
                 new_filename_on_disk = f"{base}_downloaded_{int(time.time())}{ext}" # Ensure uniqueness
                 new_filepath = os.path.join(local_dir, new_filename_on_disk)
 
-        print(f"  Target local path: {new_filepath}")
+        log(f"  Target local path: {new_filepath}")
         
         if DEMO_MODE:
-            print(f"  [DEMO MODE] Would attempt to {'export' if is_export else 'download'} file ID {file_id} ('{original_drive_name}') to '{new_filepath}'.")
-            print(f"  [DEMO MODE] Would rename placeholder '{local_placeholder_path}' to '{local_placeholder_path}.placeholder_original'.")
+            if copy_from:
+                log(f"  [DEMO MODE] Already fetched to '{copy_from}'. Would link or copy it to '{new_filepath}' instead of downloading it again.")
+            else:
+                log(f"  [DEMO MODE] Would attempt to {'export' if is_export else 'download'} file ID {file_id} ('{original_drive_name}') to '{new_filepath}'.")
+            log(f"  [DEMO MODE] Would rename placeholder '{local_placeholder_path}' to '{local_placeholder_path}.placeholder_original'.")
             return new_filepath, None
 
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
         placeholder_backup_name = local_placeholder_path + ".placeholder_original"
         renamed_placeholder = False
+        temp_filepath = None
+        partial_path = None
+        keep_partial = True # Only a transfer that was interrupted can be resumed; see the finally below
 
         try:
-            try:
-                if os.path.exists(placeholder_backup_name): os.remove(placeholder_backup_name) # remove old backup
-                os.rename(local_placeholder_path, placeholder_backup_name)
-                renamed_placeholder = True
-                print(f"  Renamed placeholder '{local_placeholder_path}' to '{placeholder_backup_name}'.")
-            except OSError as e_rename:
-                err_msg_rename = f"Warning: Could not rename placeholder '{local_placeholder_path}': {e_rename}."
-                if hasattr(e_rename, 'errno') and e_rename.errno == 1: # EPERM
-                    err_msg_rename += " This often means the file is locked or permissions are insufficient on the source file. (macOS: check 'uchg' flag)."
-                print(f"  {err_msg_rename} Download will proceed, but original placeholder remains.")
-                # Do not return here, proceed to download, but the old file won't be "archived"
-
-            while not done:
-                status, done = downloader.next_chunk()
-                if status: print(f"    Download {int(status.progress() * 100)}%.")
-            
-            with open(new_filepath, 'wb') as f:
-                f.write(fh.getvalue())
-            print(f"  Successfully saved: {new_filepath}")
+            # An earlier download being refreshed is not set aside: the new version atomically replaces it below.
+            if not replace_existing:
+                try:
+                    if os.path.exists(placeholder_backup_name): os.remove(placeholder_backup_name) # remove old backup
+                    os.rename(local_placeholder_path, placeholder_backup_name)
+                    renamed_placeholder = True
+                    log(f"  Renamed placeholder '{local_placeholder_path}' to '{placeholder_backup_name}'.")
+                except OSError as e_rename:
+                    err_msg_rename = f"Warning: Could not rename placeholder '{local_placeholder_path}': {e_rename}."
+                    if hasattr(e_rename, 'errno') and e_rename.errno == 1: # EPERM
+                        err_msg_rename += " This often means the file is locked or permissions are insufficient on the source file. (macOS: check 'uchg' flag)."
+                    log(f"  {err_msg_rename} Download will proceed, but original placeholder remains.")
+                    # Do not return here, proceed to download, but the old file won't be "archived"
+
+            # Stream chunks straight into a hidden partial file next to the target and only move it
+            # under the final name once complete, so a crash never leaves a half-written file there.
+            if copy_from:
+                method = materialize_copy(copy_from, new_filepath, copy_method)
+                log(f"  Already fetched to '{copy_from}': created a {method} instead of downloading it again.")
+                get_metrics().inc(f"local_copies_by_{method}")
+            elif is_export:
+                # Exports are rendered on request and cannot be resumed, so they always start from scratch.
+                # The temp name is fixed per placeholder, so one left behind by a crash is overwritten
+                # when the file is tried again.
+                temp_filepath = os.path.join(local_dir, f".{os.path.basename(local_placeholder_path)}.{file_id}.export{PARTIAL_DOWNLOAD_SUFFIX}")
+                with open(temp_filepath, 'wb') as f:
+                    downloader = MediaIoBaseDownload(f, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+                    done = False
+                    while not done:
+                        status, done = get_governor().call(downloader.next_chunk)
+                        if status: log(f"    Download {int(status.progress() * 100)}%.")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_filepath, new_filepath)
+                temp_filepath = None
+            else:
+                # The partial file keeps a stable name, so an interrupted download continues where it
+                # stopped on the next attempt or the next run.
+                partial_path = os.path.join(local_dir, f".{os.path.basename(local_placeholder_path)}.{file_id}{PARTIAL_DOWNLOAD_SUFFIX}")
+                verify_error = download_resumable(request, drive_file_metadata, partial_path,
+                                                  lambda: search_drive_file(service, file_id=file_id))
+                if verify_error:
+                    if renamed_placeholder:
+                        try: os.rename(placeholder_backup_name, local_placeholder_path); log(f"  Restored placeholder.")
+                        except Exception as e_restore: log(f"  Could not restore placeholder: {e_restore}")
+                    return None, verify_error
+                os.replace(partial_path, new_filepath)
+            log(f"  Successfully saved: {new_filepath}")
             return new_filepath, None
         except OSError as e_os_write: # Specifically for write error
             err_msg = f"OS error writing file '{new_filepath}': {e_os_write}."
             if hasattr(e_os_write, 'errno') and e_os_write.errno == 1: # EPERM
                  err_msg += " This could be due to a file lock (e.g., 'uchg' flag on macOS for the target path/name) or insufficient permissions in the target directory."
-            print(f"    {err_msg}")
+            log(f"    {err_msg}")
             if renamed_placeholder:
-                 try: os.rename(placeholder_backup_name, local_placeholder_path); print(f"  Restored placeholder.")
-                 except Exception as e_restore: print(f"  Could not restore placeholder: {e_restore}")
+                 try: os.rename(placeholder_backup_name, local_placeholder_path); log(f"  Restored placeholder.")
+                 except Exception as e_restore: log(f"  Could not restore placeholder: {e_restore}")
             return None, err_msg
         except HttpError as error: # For GDrive API errors during download
-            print(f"    An API error occurred during download/export for {file_id}: {error}")
+            log(f"    An API error occurred during download/export for {file_id}: {error}")
+            keep_partial = is_retryable_error(error) # A 404 or 403 will not go away on the next attempt
             if renamed_placeholder:
-                 try: os.rename(placeholder_backup_name, local_placeholder_path); print(f"  Restored placeholder.")
-                 except Exception as e_restore: print(f"  Could not restore placeholder: {e_restore}")
+                 try: os.rename(placeholder_backup_name, local_placeholder_path); log(f"  Restored placeholder.")
+                 except Exception as e_restore: log(f"  Could not restore placeholder: {e_restore}")
             return None, f"Download/Export API Error ({error.resp.status if hasattr(error,'resp') else 'Unknown'})"
         except Exception as e: # Other errors
-            print(f"    An unexpected error during download/write operation: {e}")
+            log(f"    An unexpected error during download/write operation: {e}")
             if renamed_placeholder:
-                 try: os.rename(placeholder_backup_name, local_placeholder_path); print(f"  Restored placeholder.")
-                 except Exception as e_restore: print(f"  Could not restore placeholder: {e_restore}")
+                 try: os.rename(placeholder_backup_name, local_placeholder_path); log(f"  Restored placeholder.")
+                 except Exception as e_restore: log(f"  Could not restore placeholder: {e_restore}")
             return None, f"Unexpected download/write error: {str(e)}"
+        finally:
+            if temp_filepath:
+                try: os.remove(temp_filepath)
+                except OSError: pass
+            if partial_path:
+                discard_partial_download(partial_path, keep_partial)
     return None, "Request object was not created (no download/export path)"
 
+def discard_partial_download(partial_path, keep=True):
+    """Removes what a failed download left in partial_path, unless it has data worth resuming from (and keep is set)."""
+    try:
+        if not keep or os.path.getsize(partial_path) == 0:
+            os.remove(partial_path)
+    except OSError:
+        pass # Already moved into place, or never created
+
+# --- Export Cache ---
+EXPORT_CACHE_SUFFIX = ".export"
+
+class ExportCache:
+    """On-disk cache of Google Workspace exports, shared by all threads and kept between runs.
+
+    Entries are keyed by (file ID, version or modifiedTime, export MIME type), so a document that
+    changed on Drive never matches an old entry. Using an entry marks it as recently used (its mtime);
+    the least recently used entries are evicted once the cache grows beyond max_bytes. Entries are
+    reflinks or copies, never hardlinks, so editing a repaired file does not change the cache.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """Yields (path, size, mtime) of every cached export."""
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(EXPORT_CACHE_SUFFIX) and entry.is_file():
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue # Evicted by another shard's process just now
+                    yield entry.path, st.st_size, st.st_mtime
+
+    def path_for(self, drive_file_metadata, export_mime_type):
+        revision = drive_file_metadata.get('version') or drive_file_metadata.get('modifiedTime')
+        if not revision:
+            return None # Without a revision a cached export could be stale
+        key = "\0".join((drive_file_metadata['id'], str(revision), export_mime_type))
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + EXPORT_CACHE_SUFFIX)
+
+    def get(self, drive_file_metadata, export_mime_type):
+        """Path of the cached export, or None."""
+        path = self.path_for(drive_file_metadata, export_mime_type)
+        if path is None:
+            return None
+        try:
+            os.utime(path) # Mark as recently used
+            return path
+        except OSError:
+            return None
+
+    def put(self, drive_file_metadata, export_mime_type, source_path):
+        """Adds a finished export to the cache. Failures only cost the cache entry."""
+        path = self.path_for(drive_file_metadata, export_mime_type)
+        if path is None or os.path.exists(path):
+            return
+        try:
+            size = os.path.getsize(source_path)
+            if size > self.max_bytes:
+                return
+            materialize_copy(source_path, path, first_method="reflink")
+        except OSError as e:
+            log(f"    Warning: Could not add the export to the cache: {e}")
+            return
+        get_metrics().inc('export_cache_added')
+        with self.lock:
+            self.total_bytes += size
+            over = self.total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes."""
+        with self.lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            self.total_bytes = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.total_bytes -= size
+                get_metrics().inc('export_cache_evicted')
+
+_export_cache = None
+_export_cache_lock = threading.Lock()
+
+def get_export_cache():
+    """Returns the ExportCache in EXPORT_CACHE_DIR, creating it on first use. None if the cache is disabled."""
+    global _export_cache
+    with _export_cache_lock:
+        if _export_cache is None and EXPORT_CACHE_DIR:
+            try:
+                _export_cache = ExportCache(EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES)
+            except OSError as e:
+                log(f"Warning: Could not use the export cache '{EXPORT_CACHE_DIR}': {e}")
+                return None
+        return _export_cache
+
+# --- Remote Drive Index ---
+class DriveIndex:
+    """In-memory map of every file on the Drive, built from one paged crawl.
+
+    Lookups by ID or name are dictionary hits; files sharing a name are told apart by
+    comparing their Drive folder path with the placeholder's path under LOCAL_BACKUP_PATH.
+    """
+
+    def __init__(self, files, created_at=None):
+        self.files = files
+        self.created_at = created_at or datetime.datetime.now().isoformat()
+        self.from_disk = False # Loaded from DRIVE_INDEX_FILE, so up to DRIVE_INDEX_MAX_AGE_HOURS out of date
+        self.by_id = {f['id']: f for f in files}
+        self.by_name = {}
+        for f in files:
+            self.by_name.setdefault(f['name'], []).append(f)
+        self._folder_paths = {}
+
+    def get(self, file_id):
+        return self.by_id.get(file_id)
+
+    def folder_path(self, file_metadata):
+        """Returns the Drive folder path of a file as a list of folder names, outermost first.
+        The path of every folder walked through is cached, so each parent chain is walked once."""
+        chain = [] # Folders walked through, innermost first
+        parts = []
+        parent_ids = file_metadata.get('parents') or []
+        while parent_ids:
+            parent_id = parent_ids[0]
+            if parent_id in self._folder_paths:
+                parts = list(self._folder_paths[parent_id])
+                break
+            parent = self.by_id.get(parent_id)
+            if parent is None or parent_id in chain: # Reached My Drive root or a folder we cannot see
+                break
+            chain.append(parent_id)
+            parent_ids = parent.get('parents') or []
+        for folder_id in reversed(chain):
+            parts.append(self.by_id[folder_id]['name'])
+            self._folder_paths[folder_id] = list(parts)
+        return parts
+
+    def find_by_name(self, name, local_path):
+        """Returns the non-folder Drive file called name whose folder path best matches local_path, or None."""
+        candidates = [f for f in self.by_name.get(name, []) if f['mimeType'] != FOLDER_MIMETYPE]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+
+        local_dir = os.path.relpath(os.path.dirname(local_path), LOCAL_BACKUP_PATH)
+        local_parts = [p.lower() for p in local_dir.split(os.sep) if p not in ('', '.')]
+
+        def score(f):
+            # Number of trailing folder names the Drive path and the local path have in common.
+            drive_parts = [p.lower() for p in self.folder_path(f)]
+            matched = 0
+            while (matched < len(drive_parts) and matched < len(local_parts)
+                   and drive_parts[-1 - matched] == local_parts[-1 - matched]):
+                matched += 1
+            return matched
+
+        best = max(candidates, key=score)
+        log(f"  Found {len(candidates)} files named '{name}' in the Drive index. Picked '{'/'.join(self.folder_path(best) + [name])}' "
+            f"(ID: {best['id']}) as the closest match to the local path.")
+        return best
+
+    def save(self, path):
+        temp_path = f"{path}.{os.getpid()}.tmp" # Shards may save the same index at the same time
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': self.created_at, 'fields': DRIVE_INDEX_FIELDS, 'files': self.files}, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('fields') != DRIVE_INDEX_FIELDS:
+            raise ValueError("it was built with a different set of fields")
+        drive_index = cls(data['files'], data.get('created_at'))
+        drive_index.from_disk = True
+        return drive_index
+
+def crawl_drive(service):
+    """Lists every non-trashed file and folder on the Drive with paged files.list calls."""
+    files = []
+    page_token = None
+    while True:
+        response = get_governor().execute(service.files().list(
+            q="trashed = false",
+            spaces='drive',
+            fields=f'nextPageToken, files({DRIVE_INDEX_FIELDS})',
+            pageSize=1000,
+            pageToken=page_token
+        ))
+        files.extend(response.get('files', []))
+        print(f"  Indexed {len(files)} Drive items so far...")
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return files
+
+_drive_index_built_by_launcher = False # Set in the shards of a sharded run whose launcher just crawled the Drive
+
+def load_or_build_drive_index(service):
+    """Returns a DriveIndex, reusing DRIVE_INDEX_FILE if it is recent enough. None if crawling fails."""
+    if (DRIVE_INDEX_MAX_AGE_HOURS > 0 or _drive_index_built_by_launcher) and os.path.exists(DRIVE_INDEX_FILE):
+        age_hours = (time.time() - os.path.getmtime(DRIVE_INDEX_FILE)) / 3600
+        if age_hours < DRIVE_INDEX_MAX_AGE_HOURS or _drive_index_built_by_launcher:
+            try:
+                drive_index = DriveIndex.load(DRIVE_INDEX_FILE)
+                # Crawled for this very run, so as current as an index built here.
+                drive_index.from_disk = not _drive_index_built_by_launcher
+                print(f"Loaded Drive index '{DRIVE_INDEX_FILE}' ({len(drive_index.files)} items, built {drive_index.created_at}).")
+                return drive_index
+            except (IOError, ValueError, KeyError) as e:
+                print(f"Warning: Could not load Drive index '{DRIVE_INDEX_FILE}': {e}. Rebuilding it.")
+
+    print("Building Drive index (one listing of the whole Drive)...")
+    try:
+        drive_index = DriveIndex(crawl_drive(service))
+    except HttpError as error:
+        print(f"API Error while building the Drive index: {error}. Falling back to per-file lookups.")
+        return None
+    print(f"Drive index built with {len(drive_index.files)} items.")
+    try:
+        drive_index.save(DRIVE_INDEX_FILE)
+    except IOError as e:
+        print(f"Warning: Could not save Drive index to '{DRIVE_INDEX_FILE}': {e}")
+    return drive_index
+
+# --- Run State ---
+class StateStore:
+    """SQLite record of what happened to each placeholder, keyed by local path plus size and mtime.
+
+    Results are committed every STATE_COMMIT_EVERY files, so after a crash or Ctrl-C at most
+    that many files are processed again. Safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS placeholders (
+                local_path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                drive_id TEXT,
+                outcome TEXT,
+                target_path TEXT,
+                reason TEXT,
+                demo INTEGER,
+                updated_at TEXT
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS placeholders_drive_id ON placeholders (drive_id)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        self.pending = 0
+
+    def is_finished(self, local_path, st):
+        """True if local_path was already handled and does not need to be processed again."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, outcome, target_path, demo FROM placeholders WHERE local_path = ?",
+                (local_path,)).fetchone()
+        if row is None:
+            return False
+        size, mtime_ns, outcome, target_path, demo = row
+        if DEMO_MODE or demo:
+            return False # A demo run shows what would happen to every file, and never counts as progress for a real run.
+        if outcome == 'downloaded' and target_path == local_path:
+            return True # The file at this path is the one we downloaded.
+        if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return False # The placeholder changed since it was recorded.
+        if outcome == 'failed':
+            return not RETRY_FAILED
+        return outcome in ('downloaded', 'simulated', 'matched') # 'skipped' files are classified again (no network needed)
+
+    def record(self, local_path, st, result):
+        """Stores the result for local_path. Demo results (kept only for the demo report) never replace a real-run entry."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO placeholders SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? "
+                "WHERE ? = 0 OR NOT EXISTS (SELECT 1 FROM placeholders WHERE local_path = ? AND demo = 0)",
+                (local_path, st.st_size, st.st_mtime_ns, result.get('drive_id'), result['outcome'],
+                 result.get('target_path'), result.get('reason'), int(DEMO_MODE), datetime.datetime.now().isoformat(),
+                 int(DEMO_MODE), local_path))
+            self.pending += 1
+            if self.pending >= STATE_COMMIT_EVERY:
+                self.commit()
+
+    def update_result(self, local_path, result):
+        """Records a new result for an existing entry, e.g. after re-fetching its downloaded file.
+        Size and mtime still describe the original placeholder; the target path is kept if result has none.
+        Demo runs leave the entry alone, since it belongs to a real run."""
+        if DEMO_MODE:
+            return
+        with self.lock:
+            self.conn.execute(
+                "UPDATE placeholders SET drive_id = COALESCE(?, drive_id), outcome = ?, target_path = COALESCE(?, target_path), "
+                "reason = ?, updated_at = ? WHERE local_path = ?",
+                (result.get('drive_id'), result['outcome'], result.get('target_path'), result.get('reason'),
+                 datetime.datetime.now().isoformat(), local_path))
+            self.pending += 1
+            if self.pending >= STATE_COMMIT_EVERY:
+                self.commit()
+
+    def entries_for_drive_ids(self, drive_ids):
+        """Returns (local_path, drive_id, outcome, target_path) of every real-run entry resolved to one of drive_ids."""
+        drive_ids = list(drive_ids)
+        rows = []
+        with self.lock:
+            for start in range(0, len(drive_ids), 500): # Stay below SQLite's limit on query parameters
+                chunk = drive_ids[start:start + 500]
+                rows += self.conn.execute(
+                    f"SELECT local_path, drive_id, outcome, target_path FROM placeholders "
+                    f"WHERE demo = 0 AND drive_id IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+        return rows
+
+    def failed_rows(self):
+        """Returns (local_path, drive_id, target_path) of every failed real-run entry."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT local_path, drive_id, target_path FROM placeholders WHERE outcome = 'failed' AND demo = 0").fetchall()
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+            self.conn.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def failed_entries(self, backup_path):
+        """Yields (local_path, reason) for failed placeholders under backup_path that still exist,
+        and for downloaded files whose re-fetch (see INCREMENTAL_MODE) failed."""
+        prefix = os.path.join(os.path.abspath(backup_path), '')
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT local_path, reason, target_path FROM placeholders WHERE outcome = 'failed' AND demo = ? ORDER BY local_path",
+                (int(DEMO_MODE),)).fetchall()
+        for local_path, reason, target_path in rows:
+            if not os.path.abspath(local_path).startswith(prefix):
+                continue
+            if os.path.exists(local_path):
+                yield local_path, reason
+            elif target_path and os.path.exists(target_path):
+                yield target_path, f"Could not update from Drive, local copy may be outdated. {reason}"
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
+
+# --- Incremental Runs ---
+CHANGES_TOKEN_KEY = 'changes_page_token'
+
+def get_changes_start_token(service):
+    """The changes feed cursor for 'now'."""
+    return get_governor().execute(service.changes().getStartPageToken())['startPageToken']
+
+def list_drive_changes(service, page_token):
+    """Pages through changes.list from page_token. Returns ({file_id: change}, new_start_page_token)."""
+    changes = {}
+    while True:
+        response = get_governor().execute(service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            includeRemoved=True,
+            pageSize=1000,
+            fields=CHANGES_FIELDS
+        ))
+        for change in response.get('changes', []):
+            if change.get('fileId'):
+                changes[change['fileId']] = change # Only the latest change of a file matters
+        if 'newStartPageToken' in response:
+            return changes, response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+def matches_drive_checksum(local_path, drive_file_metadata):
+    """True if the local file has the size and MD5 Drive reports (always False for exports, which have none)."""
+    expected_md5 = drive_file_metadata.get('md5Checksum')
+    if not expected_md5 or drive_file_metadata.get('size') is None:
+        return False
+    try:
+        if os.path.getsize(local_path) != int(drive_file_metadata['size']):
+            return False
+        md5 = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                md5.update(block)
+    except OSError:
+        return False
+    return md5.hexdigest() == expected_md5
+
+def plan_incremental_run(service, state, page_token):
+    """Turns the Drive changes since page_token into pipeline work items.
+
+    * Files downloaded by an earlier run, or small files that already matched Drive, whose Drive file
+      changed are re-fetched into the same local path.
+    * Placeholders that failed before are retried if the Drive file they resolved to, or a Drive file
+      with their name, was added or changed (all failed placeholders with RETRY_FAILED).
+    * Re-fetches that failed in an earlier run are retried.
+    Files removed or trashed on Drive are left alone locally. Returns (items, new_page_token, stats).
+    """
+    changes, new_token = list_drive_changes(service, page_token)
+    stats = {'changes': len(changes), 'removed': 0, 'unchanged': 0}
+    items = {}
+
+    def add_refresh(entry_path, target_path, drive_id, metadata=None):
+        item = {'local_path': target_path, 'stat': None, 'log': [], 'refresh_of': entry_path,
+                'file_id': drive_id, 'filename_to_search': os.path.basename(target_path)}
+        if metadata is not None:
+            item['metadata'] = metadata
+        items[target_path] = item
+
+    def add_placeholder(local_path):
+        try:
+            items[local_path] = {'local_path': local_path, 'stat': os.stat(local_path), 'log': []}
+        except OSError:
+            pass # Gone since the last run
+
+    live = {file_id: change['file'] for file_id, change in changes.items()
+            if not change.get('removed') and change.get('file') and not change['file'].get('trashed')}
+    for local_path, drive_id, outcome, target_path in state.entries_for_drive_ids(changes):
+        if outcome == 'matched' and target_path != local_path:
+            continue
+        if drive_id not in live:
+            if outcome in ('downloaded', 'matched'):
+                stats['removed'] += 1
+                print(f"  Removed or trashed on Drive, keeping the local copy: {target_path}")
+        elif target_path and os.path.exists(target_path) and outcome in ('downloaded', 'matched', 'failed'):
+            if outcome in ('downloaded', 'matched') and matches_drive_checksum(target_path, live[drive_id]):
+                stats['unchanged'] += 1 # Only metadata (name, sharing, ...) changed
+                continue
+            add_refresh(local_path, target_path, drive_id, live[drive_id])
+        elif outcome == 'failed':
+            add_placeholder(local_path)
+
+    live_names = {f['name'] for f in live.values()}
+    for local_path, drive_id, target_path in state.failed_rows():
+        if target_path and drive_id and os.path.exists(target_path):
+            if target_path not in items:
+                add_refresh(local_path, target_path, drive_id)
+        elif local_path not in items and os.path.exists(local_path):
+            name = os.path.basename(local_path)
+            if RETRY_FAILED or name in live_names or os.path.splitext(name)[0] in live_names:
+                add_placeholder(local_path)
+    return list(items.values()), new_token, stats
+
+# --- Repair Pipeline ---
+# Placeholders stream through the stages below, connected by bounded queues:
+#   scan -> extract shortcut ID -> resolve on Drive -> download/export -> results (main thread)
+# Between resolve and download, a DownloadScheduler takes the place of the queue and splits the
+# downloads into a small-file and a large-file lane.
+# Each stage has its own pool of threads. A full queue blocks the stage feeding it, so memory
+# stays bounded however large the backup is, and downloads start while the scan is still running.
+# Work items are dicts that collect each file's console output under 'log'; the main thread
+# prints it as one block when the file is done.
+
+_END = object() # Sent down a queue once the stage feeding it has finished.
+
+def put_item(q, item, stop):
+    """Puts item on a bounded queue, giving up (returns False) if the run is being stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def iter_queue(q, stop):
+    """Yields items from q until the end marker arrives or the run is stopped."""
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        if item is _END:
+            q.put(_END) # Let the other threads of this stage see it too
+            return
+        yield item
+
+def start_stage(name, workers, loop, in_queue, out_queue, stop, *args):
+    """Starts `workers` threads running loop(in_queue, out_queue, stop, *args).
+
+    Once the last of them returns, the end marker is passed on to out_queue.
+    """
+    workers = max(1, workers)
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def run():
+        try:
+            loop(in_queue, out_queue, stop, *args)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                put_item(out_queue, _END, stop)
+
+    threads = [threading.Thread(target=run, name=f"{name}-{i + 1}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def run_step(item, func, *args):
+    """Runs one processing step for item, collecting its console output in item['log'].
+
+    An unexpected exception fails the item instead of killing the stage thread.
+    """
+    try:
+        _, lines = call_with_buffered_log(func, *args)
+        item['log'].extend(lines)
+    except Exception as e:
+        item['log'].append(f"  Unexpected error processing {item['local_path']}: {e}")
+        item['result'] = {'outcome': 'failed', 'drive_id': (item.get('metadata') or {}).get('id'),
+                          'reason': f"Reason: Unexpected error: {e}", 'error_class': 'unexpected'}
+
+def record_lookup(item, method, started, found, histogram='lookup_seconds'):
+    """Counts one Drive lookup for item and logs it as an event."""
+    elapsed = time.monotonic() - started
+    metrics = get_metrics()
+    metrics.inc(f"lookups_{method}")
+    if histogram:
+        metrics.observe(histogram, elapsed)
+    metrics.emit('lookup', path=item['local_path'], method=method, seconds=round(elapsed, 4), found=found)
+
+def extract_candidate_id(item):
+    """Reads the Drive ID out of shortcut placeholders (.gdoc, .gsheet, ...) and picks the name to search by."""
+    local_path = item['local_path']
+    item['file_id'] = None
+    item['filename_to_search'] = os.path.basename(local_path)
+    base_local_name, local_ext = os.path.splitext(item['filename_to_search'])
+    try:
+        item['kind'] = classify_small_file(local_path)
+    except OSError as e:
+        log(f"  Could not read {local_path} to classify it: {e}")
+        item['kind'] = 'unknown'
+    get_metrics().inc(f"classified_{item['kind']}")
+
+    if item['kind'] == 'content' and local_ext.lower() not in SHORTCUT_EXTENSIONS:
+        log(f"  File has real content ({item['stat'].st_size} bytes), so it may not be a placeholder.")
+        if SKIP_FILES_WITH_CONTENT:
+            log("  Skipping it without looking it up on Drive (SKIP_FILES_WITH_CONTENT).")
+            item['result'] = {'outcome': 'skipped', 'reason': "Small file with real content (SKIP_FILES_WITH_CONTENT)"}
+            return
+    elif item['kind'] == 'shortcut' and local_ext.lower() not in SHORTCUT_EXTENSIONS:
+        log(f"  File contains Google shortcut JSON despite its '{local_ext}' extension.")
+
+    # Prioritize getting ID from Google shortcut files
+    if local_ext.lower() in SHORTCUT_EXTENSIONS or item['kind'] == 'shortcut':
+        log(f"  Detected Google shortcut type extension: {local_ext}")
+        item['file_id'] = get_id_from_google_shortcut_file(local_path)
+        if item['file_id']:
+            log(f"  Extracted Google Drive File ID: {item['file_id']}")
+        else:
+            # If ID extraction from shortcut fails, use the base name of the shortcut for searching.
+            # e.g., if "MyDoc.gdoc" (as json) is malformed, search for "MyDoc"
+            item['filename_to_search'] = base_local_name
+            log(f"  Could not get ID from shortcut file. Will search by inferred name: '{item['filename_to_search']}'")
+
+def resolve_candidate(service, item, drive_index=None):
+    """Finds the Drive file for item, falling back to a name lookup.
+
+    Sets item['metadata'] if the file can be downloaded, otherwise the failed item['result'].
+    A batched or indexed ID lookup may already have set 'metadata' (and 'lookup_error').
+    """
+    local_path, file_id, filename_to_search = item['local_path'], item['file_id'], item['filename_to_search']
+    if file_id and 'metadata' not in item:
+        started = time.monotonic()
+        item['metadata'] = search_drive_file(service, file_id=file_id)
+        record_lookup(item, 'id', started, item['metadata'] is not None)
+    elif item.get('lookup_error'):
+        log(f"  {item['lookup_error']}")
+    drive_file_info = item.get('metadata')
+
+    if not drive_file_info and 'refresh_of' in item:
+        # A re-fetch must update the very file it was downloaded from, never a same-named one.
+        log(f"  The Drive file '{file_id}' this local copy came from is gone. Keeping the local copy.")
+        item['result'] = {'outcome': 'failed', 'drive_id': file_id,
+                          'reason': f"Reason: Not found on Google Drive using ID '{file_id}'", 'error_class': 'not_found'}
+        return
+    if not drive_file_info: # Fallback to name search if ID search failed or no ID was available
+        # If it wasn't a Google shortcut type, filename_to_search is already os.basename(local_path)
+        # If it was a shortcut but ID extraction failed, filename_to_search is base_local_name
+        log(f"  No file found by ID (or no ID extracted/available). Trying search by name: '{filename_to_search}'")
+        started = time.monotonic()
+        if drive_index is not None:
+            drive_file_info = drive_index.find_by_name(filename_to_search, local_path)
+            item['metadata_unconfirmed'] = drive_index.from_disk
+            record_lookup(item, 'index_name', started, drive_file_info is not None, histogram=None)
+            if not drive_file_info and drive_index.from_disk:
+                # The saved index may predate files added to Drive since, so ask Drive itself.
+                log(f"  No file named '{filename_to_search}' in the saved Drive index (built {drive_index.created_at}).")
+                started = time.monotonic()
+                drive_file_info = search_drive_file(service, filename=filename_to_search)
+                record_lookup(item, 'name', started, drive_file_info is not None)
+            elif not drive_file_info:
+                log(f"  No file named '{filename_to_search}' in the Drive index.")
+        else:
+            drive_file_info = search_drive_file(service, filename=filename_to_search)
+            record_lookup(item, 'name', started, drive_file_info is not None)
+        item['metadata'] = drive_file_info
+
+    if not drive_file_info:
+        # Neither ID search (if applicable) nor name search found the file.
+        search_term_logged = file_id if file_id else filename_to_search
+        log(f"  File corresponding to '{local_path}' (searched as '{search_term_logged}') not found on Google Drive.")
+        item['result'] = {'outcome': 'failed', 'error_class': 'not_found',
+                          'reason': f"Reason: Not found on Google Drive using ID '{file_id if file_id else 'N/A'}' or name '{filename_to_search}'"}
+        return
+
+    drive_link = drive_file_info.get('webViewLink', 'N/A')
+    log(f"  Found on Drive: '{drive_file_info['name']}' (ID: {drive_file_info['id']}, Type: {drive_file_info['mimeType']}, Link: {drive_link})")
+    if FOLDER_MIMETYPE in drive_file_info['mimeType']:
+        log(f"  The item found on Drive is a FOLDER. Skipping for placeholder '{local_path}'.")
+        item['result'] = {'outcome': 'failed', 'drive_id': drive_file_info['id'], 'error_class': 'folder',
+                          'reason': f"Reason: Placeholder linked to a FOLDER on Drive: '{drive_file_info['name']}' ID: {drive_file_info['id']}"}
+    elif item.get('kind') in ('empty', 'content') and matches_drive_checksum(local_path, drive_file_info):
+        current = confirm_metadata(service, item)
+        if current is drive_file_info or matches_drive_checksum(local_path, current):
+            log("  The local file already has the same size and MD5 checksum as the Drive file. Nothing to download.")
+            item['result'] = {'outcome': 'matched', 'drive_id': drive_file_info['id'], 'target_path': local_path}
+
+def confirm_metadata(service, item):
+    """Returns item's Drive metadata, first read again with files().get if it came from a Drive index
+    loaded from disk: the file may have changed since. Used before trusting its checksum or version."""
+    if item.pop('metadata_unconfirmed', False):
+        current = search_drive_file(service, file_id=item['metadata']['id'])
+        if current:
+            item['metadata'] = current
+    return item['metadata']
+
+def fetch_candidate(service, item, copy_from=None):
+    """Downloads or exports the resolved Drive file over the placeholder and sets item['result'].
+    With copy_from, links or copies that earlier download of the same file instead. Exports are
+    taken from the export cache when possible, and added to it otherwise."""
+    drive_file_info = item['metadata']
+    local_path, replace_existing = item['local_path'], 'refresh_of' in item
+    export_mime_type = EXPORT_MIMETYPES.get(drive_file_info['mimeType'], {}).get('mimeType')
+    cache = get_export_cache() if export_mime_type and not copy_from else None
+    cached_path = cache.get(drive_file_info, export_mime_type) if cache else None
+    if cached_path and item.get('metadata_unconfirmed'):
+        drive_file_info = confirm_metadata(service, item) # The cached export must be of the current version
+        cached_path = cache.get(drive_file_info, export_mime_type)
+    started = time.monotonic()
+    if cached_path:
+        downloaded_path_or_simulated, error_msg = download_drive_file(service, drive_file_info, local_path, replace_existing,
+                                                                      copy_from=cached_path, copy_method="reflink")
+        if error_msg: # E.g. the entry was evicted in the meantime
+            log(f"  Could not use the cached export ({error_msg}). Exporting it from Drive instead.")
+            cached_path = None
+    if not cached_path:
+        downloaded_path_or_simulated, error_msg = download_drive_file(service, drive_file_info, local_path, replace_existing,
+                                                                      copy_from=copy_from)
+    elapsed = time.monotonic() - started
+    kind = 'export' if export_mime_type else 'download'
+    nbytes = 0
+    if downloaded_path_or_simulated and not error_msg and not DEMO_MODE:
+        try: nbytes = os.path.getsize(downloaded_path_or_simulated)
+        except OSError: pass
+    metrics = get_metrics()
+    if copy_from or cached_path:
+        kind = 'dedupe' if copy_from else 'export_cache'
+        metrics.inc(f"{kind}_files_{'ok' if not error_msg else 'failed'}")
+        if not error_msg:
+            # What fetching it again would have cost: one request per DOWNLOAD_CHUNK_SIZE chunk.
+            metrics.inc(f"{kind}_bytes_saved", nbytes)
+            metrics.inc(f"{kind}_api_calls_saved", max(1, -(-nbytes // DOWNLOAD_CHUNK_SIZE)))
+    else:
+        metrics.inc(f"{kind}s_{'ok' if not error_msg else 'failed'}")
+        metrics.inc('bytes_downloaded', nbytes)
+        metrics.observe(f"{kind}_seconds", elapsed)
+        if cache and not error_msg and not DEMO_MODE:
+            cache.put(drive_file_info, export_mime_type, downloaded_path_or_simulated)
+    failure = error_class(error_msg) if error_msg else None
+    metrics.emit(kind, path=item['local_path'], drive_id=drive_file_info['id'], mime_type=drive_file_info['mimeType'],
+                 bytes=nbytes, seconds=round(elapsed, 4), ok=not error_msg, error_class=failure)
+    if downloaded_path_or_simulated and not error_msg:
+        item['result'] = {'outcome': 'simulated' if DEMO_MODE else 'downloaded', 'drive_id': drive_file_info['id'],
+                          'target_path': downloaded_path_or_simulated}
+    else:
+        item['result'] = {'outcome': 'failed', 'drive_id': drive_file_info.get('id'), 'error_class': failure,
+                          'reason': f"Drive ID: {drive_file_info.get('id','N/A')}, Name: {drive_file_info.get('name','N/A')}, Reason: {error_msg}"}
+
+def feed_stage(out_queue, stop, items, scan_stats):
+    """Stage 1 of an incremental run: feeds the files affected by Drive changes instead of scanning."""
+    try:
+        for item in items:
+            scan_stats['candidates'] += 1
+            get_metrics().emit('placeholder_found', path=item['local_path'], refresh='refresh_of' in item, skipped=False)
+            if not put_item(out_queue, item, stop):
+                return
+    finally:
+        put_item(out_queue, _END, stop)
+
+def scan_stage(out_queue, stop, state, scan_stats):
+    """Stage 1: feeds every small file (of this shard) that the state store does not mark as finished."""
+    select = shard_selector(LOCAL_BACKUP_PATH, SHARD_INDEX, SHARD_COUNT) if SHARD_COUNT > 1 and SHARD_INDEX is not None else None
+    try:
+        for local_path, st in scan_small_files(LOCAL_BACKUP_PATH, SIZE_THRESHOLD_BYTES, EXCLUDED_EXTENSIONS, select=select, stop=stop):
+            scan_stats['candidates'] += 1
+            finished = state.is_finished(local_path, st)
+            get_metrics().emit('placeholder_found', path=local_path, size=st.st_size, skipped=finished)
+            if finished:
+                scan_stats['skipped'] += 1
+                get_metrics().inc('candidates_already_done')
+            elif not put_item(out_queue, {'local_path': local_path, 'stat': st, 'log': []}, stop):
+                return
+    finally:
+        put_item(out_queue, _END, stop)
+
+def extract_stage(in_queue, out_queue, stop):
+    """Stage 2: local shortcut ID extraction."""
+    for item in iter_queue(in_queue, stop):
+        if 'file_id' not in item: # Re-fetches of earlier downloads already know their Drive ID
+            run_step(item, extract_candidate_id, item)
+        item.setdefault('file_id', None)
+        item.setdefault('filename_to_search', os.path.basename(item['local_path']))
+        if not put_item(out_queue, item, stop):
+            return
+
+def resolve_stage(in_queue, out_queue, stop, done_queue, creds, drive_index):
+    """Stage 3: Drive lookups. IDs are collected into batch requests of up to BATCH_REQUEST_SIZE,
+    sent when full or BATCH_MAX_WAIT_SECONDS after the first ID arrived."""
+    service = get_worker_drive_service(creds)
+    pending = []
+    deadline = 0
+
+    def finish(item):
+        if 'result' not in item:
+            run_step(item, resolve_candidate, service, item, drive_index)
+        if 'result' in item:
+            done_queue.put(item)
+            return True
+        return put_item(out_queue, item, stop)
+
+    def flush():
+        started = time.monotonic()
+        results, lines = call_with_buffered_log(batch_get_drive_files, service, [item['file_id'] for item in pending])
+        for line in lines: log(line)
+        get_metrics().observe('batch_lookup_seconds', time.monotonic() - started)
+        batch = pending[:]
+        pending.clear()
+        for item in batch:
+            if item['file_id'] in results:
+                item['metadata'], item['lookup_error'] = results[item['file_id']]
+                record_lookup(item, 'batch', started, item['metadata'] is not None, histogram=None)
+            if not finish(item):
+                return False
+        return True
+
+    while not stop.is_set():
+        try:
+            item = in_queue.get(timeout=max(0.0, deadline - time.monotonic()) if pending else 0.2)
+        except queue.Empty:
+            item = None
+        if item is _END:
+            in_queue.put(_END)
+            break
+        if item is not None:
+            file_id = item['file_id']
+            if file_id and drive_index is not None and drive_index.get(file_id):
+                item['metadata'] = drive_index.get(file_id)
+                item['metadata_unconfirmed'] = drive_index.from_disk
+                record_lookup(item, 'index_id', time.monotonic(), True, histogram=None)
+            if file_id and 'metadata' not in item and 'result' not in item:
+                if not pending:
+                    deadline = time.monotonic() + BATCH_MAX_WAIT_SECONDS
+                pending.append(item)
+            elif not finish(item):
+                return
+        if pending and (len(pending) >= BATCH_REQUEST_SIZE or time.monotonic() >= deadline):
+            if not flush():
+                return
+    if pending and not stop.is_set():
+        flush()
+
+def dedupe_key(drive_file_metadata):
+    """Identifies what a download produces: the Drive file, its version and the export format (if any)."""
+    export = EXPORT_MIMETYPES.get(drive_file_metadata['mimeType'], {}).get('mimeType')
+    return drive_file_metadata['id'], drive_file_metadata.get('version'), export
+
+class DownloadDeduplicator:
+    """Makes sure each Drive file version is fetched only once per run, shared by the download threads.
+
+    The first placeholder resolving to a file downloads it. Placeholders for the same file that arrive
+    while that download is running are parked and handled by the downloading thread when it is done;
+    later ones are linked or copied from the finished file right away. If the download fails, the next
+    placeholder for the file gets its own attempt.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.entries = {} # dedupe_key -> {'path': finished download or None, 'waiters': [parked items]}
+
+    def fetch(self, service, item):
+        """Fetches item (or links it to an earlier download) and returns the items finished by this call:
+        none if item was parked behind another thread's download, item plus any items parked behind it otherwise."""
+        if not self.enabled:
+            run_step(item, fetch_candidate, service, item)
+            return [item]
+        key = dedupe_key(item['metadata'])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {'path': None, 'waiters': []}
+            elif entry['path'] is None:
+                entry['waiters'].append(item)
+                return []
+            source = entry['path']
+        if source is not None:
+            run_step(item, fetch_candidate, service, item, source)
+            if item['result']['outcome'] == 'failed':
+                # E.g. the earlier download was moved or deleted since: fetch it from Drive after all.
+                item['log'].append("  Could not link or copy the earlier download. Fetching it from Drive instead.")
+                del item['result']
+                run_step(item, fetch_candidate, service, item)
+                if item['result']['outcome'] in ('downloaded', 'simulated'):
+                    with self.lock:
+                        entry['path'] = item['result']['target_path']
+            return [item]
+
+        run_step(item, fetch_candidate, service, item)
+        result = item['result']
+        with self.lock:
+            waiters, entry['waiters'] = entry['waiters'], []
+            if result['outcome'] in ('downloaded', 'simulated'):
+                entry['path'] = result['target_path']
+            else:
+                del self.entries[key]
+        finished = [item]
+        for waiter in waiters:
+            finished += self.fetch(service, waiter)
+        return finished
+
+def estimated_download_size(drive_file_metadata):
+    """Bytes a download is expected to take: Drive's size, or a per-type guess for exports."""
+    export = EXPORT_MIMETYPES.get(drive_file_metadata['mimeType'])
+    if export:
+        return export.get('estimated_size', 0)
+    return int(drive_file_metadata.get('size') or 0)
+
+class DownloadScheduler:
+    """Sits between the resolve and download stages in place of a queue, shared by all threads.
+
+    Resolved files are sorted into a small and a large lane by estimated size
+    (LARGE_FILE_THRESHOLD_BYTES), each served by its own download threads, and wait there in
+    DOWNLOAD_ORDER. A download only starts while the estimated size of all running downloads stays
+    within MAX_BYTES_IN_FLIGHT. One file counts for at most 1/(LARGE_DOWNLOAD_WORKERS + 1) of that
+    cap, and a lane with nothing running may always start one file, so huge files can never take
+    the whole budget and starve the small lane.
+    """
+
+    def __init__(self, maxsize, order):
+        self.maxsize = maxsize
+        self.order = order
+        self.condition = threading.Condition()
+        self.lanes = {'small': [], 'large': []} # Heaps of (sort key, sequence number, item)
+        self.running = {'small': 0, 'large': 0}
+        self.sequence = 0
+        self.bytes_in_flight = 0
+        self.closed = False
+
+    def sort_key(self, item, size):
+        if self.order == "smallest_first":
+            return size
+        if self.order == "directory":
+            return os.path.dirname(item['local_path']), os.path.basename(item['local_path'])
+        return 0 # "fifo": the sequence number decides
+
+    def put(self, item, timeout=None):
+        """queue.Queue-style put for the resolve stage; _END closes the scheduler."""
+        with self.condition:
+            if item is _END:
+                self.closed = True
+            else:
+                if not self.condition.wait_for(lambda: sum(map(len, self.lanes.values())) < self.maxsize, timeout):
+                    raise queue.Full
+                size = estimated_download_size(item['metadata'])
+                lane = 'large' if size >= LARGE_FILE_THRESHOLD_BYTES else 'small'
+                item['download_cost'] = min(size, MAX_BYTES_IN_FLIGHT // (LARGE_DOWNLOAD_WORKERS + 1))
+                self.sequence += 1
+                heapq.heappush(self.lanes[lane], (self.sort_key(item, size), self.sequence, item))
+                get_metrics().inc(f"scheduled_{lane}")
+            self.condition.notify_all()
+
+    def get(self, lane, stop):
+        """Waits for the next file of a lane that fits within the cap. None once the lane is done or the run stops."""
+        with self.condition:
+            while not stop.is_set():
+                heap = self.lanes[lane]
+                if heap:
+                    cost = heap[0][2]['download_cost']
+                    if self.bytes_in_flight + cost <= MAX_BYTES_IN_FLIGHT or not self.running[lane]:
+                        item = heapq.heappop(heap)[2]
+                        item['download_lane'] = lane
+                        self.bytes_in_flight += cost
+                        self.running[lane] += 1
+                        self.condition.notify_all()
+                        return item
+                elif self.closed:
+                    return None
+                self.condition.wait(timeout=0.2)
+            return None
+
+    def done(self, item):
+        with self.condition:
+            self.bytes_in_flight -= item['download_cost']
+            self.running[item['download_lane']] -= 1
+            self.condition.notify_all()
+
+def download_stage(in_queue, out_queue, stop, creds, deduplicator, lane):
+    """Stage 4: downloads and exports of one DownloadScheduler lane. Results go to out_queue,
+    which the main thread drains."""
+    service = get_worker_drive_service(creds)
+    while True:
+        item = in_queue.get(lane, stop)
+        if item is None:
+            return
+        try:
+            if 'result' in item:
+                out_queue.put(item)
+                continue
+            for finished in deduplicator.fetch(service, item):
+                out_queue.put(finished)
+        finally:
+            in_queue.done(item)
+
 # --- Main Logic ---
+def finish_metrics(metrics, interrupted=False):
+    """Writes the end-of-run summary (and the Prometheus textfile, if enabled) and closes the event log."""
+    metrics.emit('run_end', interrupted=interrupted, counters=metrics.summary()['counters'])
+    try:
+        if RUN_SUMMARY_FILE:
+            metrics.write_summary(RUN_SUMMARY_FILE)
+            print(f"Run summary written to '{RUN_SUMMARY_FILE}'.")
+        if PROMETHEUS_TEXTFILE:
+            metrics.write_prometheus(PROMETHEUS_TEXTFILE)
+    except OSError as e:
+        print(f"Warning: Could not write run metrics: {e}")
+    metrics.close()
+
+def print_run_totals(processed_count, downloaded_count, simulated_count, lost_count, skipped_count, state_file):
+    """Prints the headline counts at the end of a run (or of merged shards)."""
+    if DEMO_MODE:
+        print(f"Total candidate files checked: {processed_count}")
+        print(f"Simulated downloads/exports: {simulated_count}")
+        print(f"Files that would be logged as lost, failed, or needing manual review: {lost_count}")
+    else:
+        print(f"Total candidate files checked: {processed_count}")
+        print(f"Successfully downloaded/exported: {downloaded_count}")
+        print(f"Files lost, failed, or needing manual review: {lost_count}")
+    if skipped_count:
+        print(f"Skipped (already handled in an earlier run, see '{state_file}'): {skipped_count}")
+
+def print_metrics_report(metrics):
+    """Prints the classification, duplicate, export cache and latency lines of the end-of-run summary."""
+    content_files = metrics.value('classified_content')
+    if content_files:
+        print(f"Candidates by content: {metrics.value('classified_empty')} empty, {metrics.value('classified_shortcut')} "
+              f"shortcut files, {content_files} with real content. Of these, {metrics.value('files_matched')} already "
+              f"matched Drive (not downloaded) and {metrics.value('files_skipped')} were skipped without a Drive lookup.")
+    dedupe_files = metrics.value('dedupe_files_ok')
+    if dedupe_files:
+        print(f"Duplicates: {dedupe_files} files were linked or copied from a download of the same Drive file "
+              f"(saved {metrics.value('dedupe_bytes_saved') / (1024 * 1024):.1f} MB and about "
+              f"{metrics.value('dedupe_api_calls_saved')} API calls).")
+    cache_hits = metrics.value('export_cache_files_ok')
+    if cache_hits or metrics.value('export_cache_added'):
+        print(f"Export cache: {cache_hits} exports reused from '{EXPORT_CACHE_DIR}' "
+              f"(saved {metrics.value('export_cache_bytes_saved') / (1024 * 1024):.1f} MB and about "
+              f"{metrics.value('export_cache_api_calls_saved')} API calls), {metrics.value('export_cache_added')} added, "
+              f"{metrics.value('export_cache_evicted')} evicted.")
+    if dedupe_files or cache_hits:
+        print(f"Local copies made instead of downloads: {metrics.value('local_copies_by_hardlink')} hardlinks, "
+              f"{metrics.value('local_copies_by_reflink')} reflinks, {metrics.value('local_copies_by_copy')} copies.")
+    for name in ('lookup_seconds', 'batch_lookup_seconds', 'download_seconds', 'export_seconds'):
+        histogram = metrics.histograms.get(name)
+        if histogram and histogram.count:
+            print(f"{name}: {histogram.count} timed, mean {histogram.sum / histogram.count:.2f} s, "
+                  f"p50 <= {histogram.quantile(0.5)} s, p90 <= {histogram.quantile(0.9)} s")
+
+def write_lost_files_report(lost_and_failed_files):
+    """Writes LOST_FILES_LOG, the list of files that still need attention."""
+    print(f"\nWriting details of {len(lost_and_failed_files)} problematic files to '{LOST_FILES_LOG}'...")
+    try:
+        with open(LOST_FILES_LOG, 'w', encoding='utf-8') as f:
+            f.write(f"Report generated on: {datetime.datetime.now().isoformat()}\n")
+            f.write(f"DEMO MODE ACTIVE: {DEMO_MODE}\n")
+            f.write(f"Local Backup Path Scanned: {os.path.abspath(LOCAL_BACKUP_PATH)}\n")
+            f.write(f"Size Threshold: < {SIZE_THRESHOLD_BYTES} bytes\n")
+            f.write(f"Excluded Extensions: {', '.join(EXCLUDED_EXTENSIONS)}\n\n")
+            f.write("--- Files Not Found, Failed to Download/Export, or Requiring Manual Attention ---\n")
+            for item in lost_and_failed_files:
+                f.write(f"{item}\n")
+        print(f"Log file '{LOST_FILES_LOG}' created successfully.")
+        print("Please review this log. For local permission errors, you may need to adjust folder/file permissions or unlock them.")
+        print("For 'File too large' errors, manual download from Google Drive website is needed for those specific files.")
+        print("For 'File not found' errors, the file may have been deleted or moved on Google Drive.")
+    except IOError as e:
+        print(f"Error: Could not write to log file '{LOST_FILES_LOG}': {e}")
+
 def main():
     print(f"Script starting at: {datetime.datetime.now().isoformat()}")
     if DEMO_MODE:
@@ -304,6 +2088,8 @@ def main():
     print(f"Local backup path: {LOCAL_BACKUP_PATH}")
     print(f"File size threshold: < {SIZE_THRESHOLD_BYTES} bytes")
     print(f"Excluded extensions: {EXCLUDED_EXTENSIONS}")
+    if SHARD_COUNT > 1 and SHARD_INDEX is not None:
+        print(f"Shard {SHARD_INDEX} of {SHARD_COUNT} (shards are numbered from 0). State: '{STATE_DB_FILE}'.")
 
     if LOCAL_BACKUP_PATH == "/path/to/your/local/google-drive-backup" and not DEMO_MODE: # Added not DEMO_MODE
         print("\nCRITICAL ERROR: 'LOCAL_BACKUP_PATH' is set to the default placeholder.")
@@ -325,105 +2111,317 @@ def main():
             print("Pre-run write permission check passed for the root backup directory.")
 
 
-    drive_service = get_drive_service()
+    creds = get_credentials()
+    drive_service = get_drive_service(creds)
     if not drive_service:
         print("Could not connect to Google Drive. Exiting.")
         return
 
-    print("\nScanning for small files (potential placeholders)...")
-    candidate_files = find_small_files(LOCAL_BACKUP_PATH, SIZE_THRESHOLD_BYTES, EXCLUDED_EXTENSIONS)
-
-    if not candidate_files:
-        print("No files found matching the criteria. Your backup might be complete or criteria are too restrictive.")
-        return
+    state = StateStore(STATE_DB_FILE)
+    # The changes feed cursor is taken before any work starts and only stored once the run completes,
+    # so changes made on Drive while this run is busy are picked up by the next one.
+    changes_token = None
+    incremental_items = None
+    changes_stats = None
+    if DEMO_MODE:
+        if INCREMENTAL_MODE: print("Incremental mode is not used in DEMO MODE; scanning the whole backup.")
+    else:
+        stored_token = state.get_meta(CHANGES_TOKEN_KEY)
+        try:
+            if INCREMENTAL_MODE and stored_token:
+                print("\nIncremental mode: reading the Drive changes since the last completed run...")
+                incremental_items, changes_token, changes_stats = plan_incremental_run(drive_service, state, stored_token)
+                print(f"{changes_stats['changes']} Drive files changed; {len(incremental_items)} local files are affected.")
+            else:
+                if INCREMENTAL_MODE: print("\nIncremental mode: no completed run recorded yet, so this run scans the whole backup.")
+                changes_token = get_changes_start_token(drive_service)
+        except HttpError as error:
+            print(f"Warning: Could not read the Drive changes feed: {error}. Scanning the whole backup instead.")
+            incremental_items = None
 
-    print(f"Found {len(candidate_files)} candidate files to check against Google Drive.")
-    lost_and_failed_files = []
+    if incremental_items is None:
+        print("\nScanning for small files (potential placeholders) and processing them as they are found...")
+    print(f"Threads per stage: scan {SCAN_WORKERS}, extract {EXTRACT_WORKERS}, resolve {RESOLVE_WORKERS}, "
+          f"download {DOWNLOAD_WORKERS} (+{LARGE_DOWNLOAD_WORKERS} for large files). Download order: {DOWNLOAD_ORDER}.")
+    stop = threading.Event()
+    scan_stats = {'candidates': 0, 'skipped': 0}
+    processed_count = 0
     successfully_processed_count = 0
     simulated_download_count = 0
+    failed_count = 0
+    threads = []
+    candidates_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    extracted_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    scheduler = DownloadScheduler(PIPELINE_QUEUE_SIZE, DOWNLOAD_ORDER)
+    done_queue = queue.Queue() # Unbounded: it only ever holds files that are already finished.
+    metrics = get_metrics()
+    metrics.emit('run_start', backup_path=LOCAL_BACKUP_PATH, demo_mode=DEMO_MODE)
+    progress = ProgressView()
+
+    def show_progress(force=False):
+        progress.update(processed_count, processed_count - failed_count, failed_count, scan_stats, force)
+
+    def record_result(item):
+        # Results are tallied here, on the main thread, so the counters need no locking.
+        nonlocal processed_count, successfully_processed_count, simulated_download_count, failed_count
+        processed_count += 1
+        result = item['result']
+        if result['outcome'] == 'downloaded': successfully_processed_count += 1
+        elif result['outcome'] == 'simulated': simulated_download_count += 1
+        elif result['outcome'] == 'failed': failed_count += 1
+        failure = result.get('error_class', 'other') if result['outcome'] == 'failed' else None
+        metrics.inc(f"files_{result['outcome']}")
+        if failure:
+            metrics.inc(f"errors_{failure}")
+        metrics.emit('file_done', path=item['local_path'], outcome=result['outcome'], drive_id=result.get('drive_id'),
+                     target_path=result.get('target_path'), error_class=failure, reason=result.get('reason'))
+        if 'refresh_of' in item:
+            state.update_result(item['refresh_of'], result)
+        else:
+            state.record(item['local_path'], item['stat'], result)
+        if VERBOSE:
+            flush_log([f"\n--- Processing file {processed_count}: {item['local_path']} ---"] + item['log'])
+        else:
+            show_progress()
 
-    for i, local_path in enumerate(candidate_files):
-        print(f"\n--- Processing file {i+1}/{len(candidate_files)}: {local_path} ---")
-        file_id = None
-        filename_to_search = os.path.basename(local_path)
-        base_local_name, local_ext = os.path.splitext(filename_to_search)
-
-        # Prioritize getting ID from Google shortcut files
-        if local_ext.lower() in ['.gdoc', '.gsheet', '.gslides', '.gform', '.gdraw', '.gtable', '.gjam']:
-            print(f"  Detected Google shortcut type extension: {local_ext}")
-            file_id = get_id_from_google_shortcut_file(local_path)
-            if file_id:
-                print(f"  Extracted Google Drive File ID: {file_id}")
+    try:
+        try:
+            if incremental_items is not None:
+                scanner = threading.Thread(target=feed_stage, args=(candidates_queue, stop, incremental_items, scan_stats),
+                                           name="changes", daemon=True)
             else:
-                # If ID extraction from shortcut fails, use the base name of the shortcut for searching.
-                # e.g., if "MyDoc.gdoc" (as json) is malformed, search for "MyDoc"
-                filename_to_search = base_local_name 
-                print(f"  Could not get ID from shortcut file. Will search by inferred name: '{filename_to_search}'")
-        
-        drive_file_info = None
-        if file_id:
-            drive_file_info = search_drive_file(drive_service, file_id=file_id)
-        
-        if not drive_file_info: # Fallback to name search if ID search failed or no ID was available
-            # If it wasn't a Google shortcut type, filename_to_search is already os.basename(local_path)
-            # If it was a shortcut but ID extraction failed, filename_to_search is base_local_name
-            print(f"  No file found by ID (or no ID extracted/available). Trying search by name: '{filename_to_search}'")
-            drive_file_info = search_drive_file(drive_service, filename=filename_to_search)
-
-        if drive_file_info:
-            drive_link = drive_file_info.get('webViewLink', 'N/A')
-            print(f"  Found on Drive: '{drive_file_info['name']}' (ID: {drive_file_info['id']}, Type: {drive_file_info['mimeType']}, Link: {drive_link})")
-            
-            if 'application/vnd.google-apps.folder' in drive_file_info['mimeType']:
-                print(f"  The item found on Drive is a FOLDER. Skipping for placeholder '{local_path}'.")
-                lost_and_failed_files.append(f"{local_path} (Reason: Placeholder linked to a FOLDER on Drive: '{drive_file_info['name']}' ID: {drive_file_info['id']})")
-                continue
+                scanner = threading.Thread(target=scan_stage, args=(candidates_queue, stop, state, scan_stats), name="scan", daemon=True)
+            scanner.start()
+            threads.append(scanner)
+            threads += start_stage("extract", EXTRACT_WORKERS, extract_stage, candidates_queue, extracted_queue, stop)
+            # The scan keeps running (up to the queue limits) while the index is built.
+            # An incremental run touches too few files to be worth a crawl of the whole Drive.
+            drive_index = load_or_build_drive_index(drive_service) if USE_DRIVE_INDEX and incremental_items is None else None
+            threads += start_stage("resolve", RESOLVE_WORKERS, resolve_stage, extracted_queue, scheduler, stop,
+                                   done_queue, creds, drive_index)
+            deduplicator = DownloadDeduplicator(DEDUPLICATE_DOWNLOADS)
+            threads += start_stage("download", DOWNLOAD_WORKERS, download_stage, scheduler, done_queue, stop, creds,
+                                   deduplicator, 'small')
+            threads += start_stage("download-large", LARGE_DOWNLOAD_WORKERS, download_stage, scheduler, done_queue, stop, creds,
+                                   deduplicator, 'large')
+            running_lanes = 2 # Each download lane sends its own end marker
+            while running_lanes:
+                try:
+                    item = done_queue.get(timeout=PROGRESS_INTERVAL_SECONDS)
+                except queue.Empty:
+                    if not VERBOSE: show_progress() # Keep the status line alive while lookups or big downloads run
+                    continue
+                if item is _END:
+                    running_lanes -= 1
+                else:
+                    record_result(item)
+            if not VERBOSE: show_progress(force=True)
+        except KeyboardInterrupt:
+            print("\nInterrupted. Letting files already in progress finish, then saving progress...")
+            stop.set()
+            for thread in threads:
+                thread.join()
+            while True:
+                try:
+                    item = done_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _END:
+                    record_result(item)
+            state.commit()
+            print(f"Progress saved to '{STATE_DB_FILE}' ({processed_count} files processed this run). Run the script again to continue.")
+            finish_metrics(metrics, interrupted=True)
+            return
 
-            downloaded_path_or_simulated, error_msg = download_drive_file(drive_service, drive_file_info, local_path)
-            
-            if downloaded_path_or_simulated and not error_msg:
-                if DEMO_MODE: simulated_download_count +=1
-                else: successfully_processed_count += 1
+        if changes_token:
+            state.set_meta(CHANGES_TOKEN_KEY, changes_token)
+        if not scan_stats['candidates']:
+            if incremental_items is not None:
+                print("No local files are affected by the Drive changes since the last run.")
             else:
-                lost_and_failed_files.append(f"{local_path} (Drive ID: {drive_file_info.get('id','N/A')}, Name: {drive_file_info.get('name','N/A')}, Reason: {error_msg})")
-        else:
-            # This 'else' means neither ID search (if applicable) nor name search found the file.
-            search_term_logged = file_id if file_id else filename_to_search
-            print(f"  File corresponding to '{local_path}' (searched as '{search_term_logged}') not found on Google Drive.")
-            lost_and_failed_files.append(f"{local_path} (Reason: Not found on Google Drive using ID '{file_id if file_id else 'N/A'}' or name '{filename_to_search}')")
+                print("No files found matching the criteria. Your backup might be complete or criteria are too restrictive.")
+            finish_metrics(metrics)
+            return
+        state.commit()
+        # The report covers every placeholder still failing, including ones skipped this run.
+        lost_and_failed_files = [f"{local_path} ({reason})" for local_path, reason in state.failed_entries(LOCAL_BACKUP_PATH)]
+    finally:
+        state.close()
 
     print("\n--- Script Finished ---")
-    if DEMO_MODE:
-        print(f"Total candidate files checked: {len(candidate_files)}")
-        print(f"Simulated downloads/exports: {simulated_download_count}")
-        print(f"Files that would be logged as lost, failed, or needing manual review: {len(lost_and_failed_files)}")
-    else:
-        print(f"Total candidate files checked: {len(candidate_files)}")
-        print(f"Successfully downloaded/exported: {successfully_processed_count}")
-        print(f"Files lost, failed, or needing manual review: {len(lost_and_failed_files)}")
+    print_run_totals(processed_count, successfully_processed_count, simulated_download_count, len(lost_and_failed_files),
+                     scan_stats['skipped'], STATE_DB_FILE)
+    if changes_stats:
+        print(f"Drive changes since the last run: {changes_stats['changes']} ({changes_stats['unchanged']} downloaded files "
+              f"already up to date, {changes_stats['removed']} removed or trashed on Drive with their local copies kept).")
+    print(get_governor().summary())
+    print_metrics_report(metrics)
+    finish_metrics(metrics)
 
     if lost_and_failed_files:
-        print(f"\nWriting details of {len(lost_and_failed_files)} problematic files to '{LOST_FILES_LOG}'...")
-        try:
-            with open(LOST_FILES_LOG, 'w', encoding='utf-8') as f:
-                f.write(f"Report generated on: {datetime.datetime.now().isoformat()}\n")
-                f.write(f"DEMO MODE ACTIVE: {DEMO_MODE}\n")
-                f.write(f"Local Backup Path Scanned: {os.path.abspath(LOCAL_BACKUP_PATH)}\n")
-                f.write(f"Size Threshold: < {SIZE_THRESHOLD_BYTES} bytes\n")
-                f.write(f"Excluded Extensions: {', '.join(EXCLUDED_EXTENSIONS)}\n\n")
-                f.write("--- Files Not Found, Failed to Download/Export, or Requiring Manual Attention ---\n")
-                for item in lost_and_failed_files:
-                    f.write(f"{item}\n")
-            print(f"Log file '{LOST_FILES_LOG}' created successfully.")
-            print("Please review this log. For local permission errors, you may need to adjust folder/file permissions or unlock them.")
-            print("For 'File too large' errors, manual download from Google Drive website is needed for those specific files.")
-            print("For 'File not found' errors, the file may have been deleted or moved on Google Drive.")
-        except IOError as e:
-            print(f"Error: Could not write to log file '{LOST_FILES_LOG}': {e}")
-    elif len(candidate_files) > 0 :
+        write_lost_files_report(lost_and_failed_files)
+    elif scan_stats['candidates'] > 0 :
          print("\nAll candidate files were successfully processed or accounted for (no items in lost/failed list).")
     else:
         print("\nNo candidate files to process.")
 
+# --- Sharded Runs ---
+# With SHARD_COUNT > 1 the backup is split by a hash of each file's path relative to LOCAL_BACKUP_PATH,
+# so every host and every run agrees on which shard a file belongs to. Each shard runs as its own
+# process with its own Drive session and its own state database, event log, run summary and report
+# (named after the usual files, e.g. drive_backup_fixer_state.shard-2-of-4.sqlite3). --merge combines
+# them into the usual LOST_FILES_LOG and RUN_SUMMARY_FILE.
+def shard_selector(backup_path, shard_index, shard_count):
+    """Returns a function telling whether a path under backup_path belongs to the given shard."""
+    root = os.path.join(backup_path, '')
+
+    def select(path):
+        relative = path[len(root):] if path.startswith(root) else os.path.relpath(path, backup_path)
+        # Same key on every OS: '/' separators and NFC (macOS file systems hand out decomposed names).
+        relative = unicodedata.normalize('NFC', relative.replace(os.sep, '/'))
+        digest = hashlib.md5(relative.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % shard_count == shard_index
+
+    return select
+
+def shard_file_name(path, shard_index, shard_count):
+    """Per-shard name of one of the script's files: name.ext -> name.shard-I-of-N.ext."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard_index}-of-{shard_count}{ext}"
+
+def configure_shard(shard_index, shard_count):
+    """Switches the settings of this process to one shard: its own files, and its share of the API limits."""
+    global SHARD_INDEX, SHARD_COUNT, STATE_DB_FILE, LOST_FILES_LOG, EVENT_LOG_FILE, RUN_SUMMARY_FILE, PROMETHEUS_TEXTFILE
+    global API_MAX_QPS, API_BURST, API_MAX_CONCURRENCY
+    SHARD_INDEX, SHARD_COUNT = shard_index, shard_count
+    STATE_DB_FILE = shard_file_name(STATE_DB_FILE, shard_index, shard_count)
+    LOST_FILES_LOG = shard_file_name(LOST_FILES_LOG, shard_index, shard_count)
+    if EVENT_LOG_FILE:
+        EVENT_LOG_FILE = shard_file_name(EVENT_LOG_FILE, shard_index, shard_count)
+    if RUN_SUMMARY_FILE:
+        RUN_SUMMARY_FILE = shard_file_name(RUN_SUMMARY_FILE, shard_index, shard_count)
+    PROMETHEUS_TEXTFILE = None # Written once for all shards by --merge
+    # The API limits are for all shards together: they share one account's quota.
+    API_MAX_QPS = API_MAX_QPS / shard_count
+    API_BURST = max(1, API_BURST // shard_count)
+    API_MAX_CONCURRENCY = max(API_MIN_CONCURRENCY, API_MAX_CONCURRENCY // shard_count)
+
+def run_all_shards(shard_count):
+    """Runs every shard in its own process on this machine, waits for all of them and merges their results."""
+    print(f"Script starting at: {datetime.datetime.now().isoformat()}")
+    if not os.path.isdir(LOCAL_BACKUP_PATH):
+        print(f"Error: Local backup path '{LOCAL_BACKUP_PATH}' does not exist or is not a directory.")
+        return
+    # Sign in once here, so the shards find a valid token instead of all opening a browser at once.
+    creds = get_credentials()
+    shard_options = []
+    if USE_DRIVE_INDEX and not INCREMENTAL_MODE:
+        # Built once and saved, so every shard loads it instead of crawling the whole Drive itself,
+        # even with DRIVE_INDEX_MAX_AGE_HOURS = 0.
+        drive_service = get_drive_service(creds)
+        drive_index = load_or_build_drive_index(drive_service) if drive_service else None
+        if drive_index is not None and not drive_index.from_disk and os.path.exists(DRIVE_INDEX_FILE):
+            # The shards may trust it like a freshly crawled index; an older one they load (and check) as usual.
+            shard_options.append('--drive-index-built')
+
+    processes = []
+    for index in range(shard_count):
+        if RUN_SUMMARY_FILE and os.path.exists(shard_file_name(RUN_SUMMARY_FILE, index, shard_count)):
+            os.remove(shard_file_name(RUN_SUMMARY_FILE, index, shard_count)) # Never merge a summary left over from an earlier run
+        console_log_path = shard_file_name(SHARD_CONSOLE_LOG, index, shard_count)
+        console_log = open(console_log_path, 'w', encoding='utf-8')
+        command = [sys.executable, '-u', os.path.abspath(__file__), '--shard-count', str(shard_count), '--shard-index', str(index)]
+        command += shard_options
+        processes.append((index, subprocess.Popen(command, stdout=console_log, stderr=subprocess.STDOUT), console_log, console_log_path))
+        print(f"Started shard {index} of {shard_count} (console output in '{console_log_path}').")
+
+    try:
+        for index, process, console_log, console_log_path in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        # Ctrl-C reaches the shards too; each one finishes its files in progress and saves its state.
+        print("\nInterrupted. Waiting for the shards to save their progress...")
+        for index, process, console_log, console_log_path in processes:
+            process.wait()
+    for index, process, console_log, console_log_path in processes:
+        console_log.close()
+        if process.returncode:
+            print(f"Warning: Shard {index} exited with code {process.returncode}, see '{console_log_path}'.")
+    merge_shards(shard_count)
+
+def merge_shards(shard_count):
+    """Combines the state databases and run summaries of all shards into LOST_FILES_LOG and RUN_SUMMARY_FILE."""
+    print(f"\nMerging the results of {shard_count} shards...")
+    lost_and_failed_files = []
+    summaries = []
+    for index in range(shard_count):
+        state_path = shard_file_name(STATE_DB_FILE, index, shard_count)
+        if os.path.exists(state_path):
+            state = StateStore(state_path)
+            try:
+                lost_and_failed_files += [f"{local_path} ({reason})" for local_path, reason in state.failed_entries(LOCAL_BACKUP_PATH)]
+            finally:
+                state.close()
+        else:
+            print(f"Warning: Shard {index} has no state database '{state_path}'; its files are missing from the report.")
+        summary_path = shard_file_name(RUN_SUMMARY_FILE, index, shard_count) if RUN_SUMMARY_FILE else None
+        try:
+            if summary_path:
+                with open(summary_path, 'r', encoding='utf-8') as f:
+                    summaries.append(json.load(f))
+        except (IOError, ValueError) as e:
+            print(f"Warning: Could not read the run summary of shard {index}: {e}. Its counts are missing from the totals.")
+    lost_and_failed_files.sort()
+
+    metrics = Metrics.from_summaries(summaries)
+    outcomes = {outcome: metrics.value(f"files_{outcome}") for outcome in ('downloaded', 'simulated', 'failed', 'matched', 'skipped')}
+    print(f"\n--- Shards Merged ({len(summaries)} of {shard_count} run summaries) ---")
+    print_run_totals(sum(outcomes.values()), outcomes['downloaded'], outcomes['simulated'], len(lost_and_failed_files),
+                     metrics.value('candidates_already_done'), shard_file_name(STATE_DB_FILE, '*', shard_count))
+    if metrics.api:
+        print(f"Drive API (all shards): {metrics.api.get('requests', 0)} requests, {metrics.api.get('retries', 0)} retries, "
+              f"{metrics.api.get('quota_errors', 0)} quota errors.")
+    print_metrics_report(metrics)
+    finish_metrics(metrics)
+
+    if lost_and_failed_files:
+        write_lost_files_report(lost_and_failed_files)
+    else:
+        print("\nNo shard reported lost or failed files.")
+
+def command_line():
+    global _drive_index_built_by_launcher
+    parser = argparse.ArgumentParser(
+        description="Replaces placeholder files in a local Google Drive backup with the real files from Drive. "
+                    "All other settings are at the top of this script.")
+    parser.add_argument('--shard-count', type=int, default=SHARD_COUNT, metavar='N',
+                        help="Split the backup into N shards. Without --shard-index, runs one process per shard on "
+                             "this machine and merges their results (default: SHARD_COUNT).")
+    parser.add_argument('--shard-index', type=int, default=SHARD_INDEX, metavar='I',
+                        help="Only process shard I (0 to N-1), e.g. to spread the shards over several hosts.")
+    parser.add_argument('--merge', action='store_true',
+                        help="Don't process anything; combine the results of all N shards into one report and summary.")
+    parser.add_argument('--drive-index-built', action='store_true',
+                        help="DRIVE_INDEX_FILE was just crawled for this run: load it whatever DRIVE_INDEX_MAX_AGE_HOURS says "
+                             "and trust it like a fresh index. A sharded run passes this to its shards.")
+    args = parser.parse_args()
+    if args.shard_count < 1:
+        parser.error("--shard-count must be at least 1")
+    if args.shard_index is not None and not 0 <= args.shard_index < args.shard_count:
+        parser.error(f"--shard-index must be between 0 and {args.shard_count - 1}")
+    if args.merge and args.shard_count == 1:
+        parser.error("--merge needs --shard-count (or SHARD_COUNT) greater than 1")
+
+    _drive_index_built_by_launcher = args.drive_index_built
+    if args.merge:
+        merge_shards(args.shard_count)
+    elif args.shard_count == 1:
+        main()
+    elif args.shard_index is None:
+        run_all_shards(args.shard_count)
+    else:
+        configure_shard(args.shard_index, args.shard_count)
+        main()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    command_line()
\ No newline at end of file